@@ -0,0 +1,53 @@
+import sys, time, random, string, argparse
+
+# Micro-benchmark: the old REQUIRED_KEYWORDS scan vs. the compiled rule (one trie-shaped regex).
+#
+#   python bench_rules.py
+#   python bench_rules.py --sizes 10,100,1000,5000 --messages 2000 --length 300
+
+import watcher
+from fake_botapi import FakeEvent
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Keyword matching micro-benchmark")
+    ap.add_argument("--sizes", default="10,100,1000,5000", help="comma-separated keyword counts")
+    ap.add_argument("--messages", type=int, default=2000, help="messages per run")
+    ap.add_argument("--length", type=int, default=300, help="average message length in characters")
+    ap.add_argument("--hit-ratio", type=float, default=0.05, help="share of messages containing a keyword")
+    ap.add_argument("--seed", type=int, default=1)
+    return ap.parse_args()
+
+def word(rnd, lo=4, hi=10):
+    return "".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(lo, hi)))
+
+def corpus(rnd, keywords, n, length, hit_ratio):
+    out = []
+    for _ in range(n):
+        words = []
+        while sum(len(w) + 1 for w in words) < length: words.append(word(rnd, 2, 8))
+        if rnd.random() < hit_ratio: words.insert(rnd.randrange(len(words)), rnd.choice(keywords))
+        out.append(" ".join(words).capitalize())
+    return out
+
+def timed(fn, texts):
+    t0 = time.perf_counter(); hits = sum(1 for t in texts if fn(t)); dt = time.perf_counter() - t0
+    return hits, 1e6 * dt / len(texts)
+
+def main():
+    args = parse_args(); rnd = random.Random(args.seed)
+    print(f"{'keywords':>8} {'scan µs/msg':>12} {'compiled µs/msg':>16} {'compile ms':>11} {'speedup':>8}")
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        keywords = list({word(rnd, 6, 12) for _ in range(size)})
+        texts = corpus(rnd, keywords, args.messages, args.length, args.hit_ratio)
+        def scan(text):
+            body = text.lower()
+            return any(k in body for k in keywords)
+        c0 = time.perf_counter(); rule = watcher.CompiledRule({"any": keywords}); compile_ms = 1000 * (time.perf_counter() - c0)
+        events = {t: FakeEvent(0, 0, t) for t in texts}
+        compiled = lambda text: rule.check(events[text]) is None
+        scan_hits, scan_us = timed(scan, texts); rule_hits, rule_us = timed(compiled, texts)
+        if scan_hits != rule_hits: print(f"mismatch at {size} keywords: scan {scan_hits} vs compiled {rule_hits}", file=sys.stderr); sys.exit(1)
+        print(f"{len(keywords):>8} {scan_us:>12.1f} {rule_us:>16.1f} {compile_ms:>11.1f} {scan_us / rule_us:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import time
+import asyncio
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any, Tuple
+
+from aiohttp import web
+
+# Local stand-in for the Telegram Bot API (https://api.telegram.org/bot<token>/<method>).
+# Used by loadtest.py and `tester.py --probe --fake` so the hot path can be measured
+# with no network: point the watcher at it with BOT_API_BASE=http://127.0.0.1:<port>.
+# FakeEvent stands in for the Telethon events those scripts and bench_rules.py feed in.
+
+# --- Fake Telethon events ---
+class FakeMessage:
+    __slots__ = ("media",)
+    def __init__(self): self.media = None
+
+class FakeSender:
+    __slots__ = ("id", "username")
+    def __init__(self, uid, username): self.id = uid; self.username = username
+
+class FakeEvent:
+    # the attributes the watcher's trigger handler and rules read from a telethon NewMessage.Event
+    __slots__ = ("chat_id", "sender_id", "sender", "date", "raw_text", "id", "message")
+    def __init__(self, chat_id, sender_id, text, msg_id=0, username=None):
+        self.chat_id = chat_id; self.sender_id = sender_id; self.sender = FakeSender(sender_id, username or f"user{sender_id}")
+        self.date = datetime.now(timezone.utc); self.raw_text = text; self.id = msg_id; self.message = FakeMessage()
+    async def get_sender(self): return self.sender
+
+# --- Fake Bot API ---
+
+class FakeBotApi:
+    def __init__(self, latency_ms: float = 0.0, rate_limit_every: int = 0, retry_after: int = 1,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency_ms / 1000.0
+        self.rate_limit_every = rate_limit_every  # every Nth sendMessage answers 429
+        self.retry_after = retry_after
+        self.host = host; self.port = port
+        self.sent: List[Tuple[float, int, str]] = []  # (time.time(), chat_id, text)
+        self.files: List[Tuple[float, int, str, str, int]] = []  # (time.time(), chat_id, method, filename, bytes)
+        self.calls: Dict[str, int] = {}
+        self.rate_limited = 0
+        self.webhook: Optional[str] = None
+        self._updates: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self._update_id = 0
+        self._listeners = []
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def on_message(self, fn):
+        # fn(ts, chat_id, text) is called for every accepted sendMessage
+        self._listeners.append(fn); return fn
+
+    def push_update(self, text: str, chat_id: int = 1, user_id: int = 1):
+        # queue a user message for the next getUpdates call
+        self._update_id += 1
+        self._updates.put_nowait({"update_id": self._update_id, "message": {
+            "message_id": self._update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "private"}, "from": {"id": user_id, "is_bot": False}}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app); await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port); await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        if self._runner: await self._runner.cleanup(); self._runner = None
+
+    async def start_bot(self, name: str):
+        # a started watcher.SimpleBot posting to this API as chat 1; import watcher (which reads
+        # its config at import time) only after setting STATE_PATH and friends
+        import watcher
+        bot = watcher.SimpleBot(name, watcher.STATE_PATH); bot.base = f"{self.base_url}/bot{name}"; bot.chat_id = 1
+        await bot.start(); return bot
+
+    async def _handle(self, request: web.Request):
+        method = request.match_info["method"]
+        n = self.calls[method] = self.calls.get(method, 0) + 1  # taken before the latency sleep: sends overlap
+        if request.content_type.startswith("multipart/"): params = await self._read_multipart(request)
+        else: params: Dict[str, Any] = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        if self.latency and method != "getUpdates": await asyncio.sleep(self.latency)
+        handler = getattr(self, f"_m_{method}", None)
+        if handler is None: return web.json_response({"ok": True, "result": True})
+        return await handler(params, n)
+
+    async def _read_multipart(self, request: web.Request) -> Dict[str, Any]:
+        # file parts are counted, not kept, like a real upload sink
+        params: Dict[str, Any] = {}
+        reader = await request.multipart()
+        async for part in reader:
+            if part.filename:
+                size = 0
+                while chunk := await part.read_chunk(): size += len(chunk)
+                params["_file"] = (part.filename, size)
+            else: params[part.name] = await part.text()
+        return params
+
+    async def _m_upload(self, method: str, params):
+        ts = time.time(); chat_id = int(params.get("chat_id", 0)); name, size = params.get("_file", ("", 0))
+        self.files.append((ts, chat_id, method, name, size))
+        return web.json_response({"ok": True, "result": {"message_id": len(self.sent) + len(self.files), "date": int(ts),
+                                                          "chat": {"id": chat_id}, "caption": params.get("caption", "")}})
+
+    async def _m_sendPhoto(self, params, n): return await self._m_upload("sendPhoto", params)
+    async def _m_sendVideo(self, params, n): return await self._m_upload("sendVideo", params)
+    async def _m_sendDocument(self, params, n): return await self._m_upload("sendDocument", params)
+
+    async def _m_getMe(self, params, n):
+        return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "username": "fake_bot"}})
+
+    async def _m_sendMessage(self, params, n):
+        if self.rate_limit_every and n % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": f"Too Many Requests: retry after {self.retry_after}",
+                                      "parameters": {"retry_after": self.retry_after}}, status=429)
+        ts = time.time(); chat_id = int(params.get("chat_id", 0)); text = params.get("text", "")
+        self.sent.append((ts, chat_id, text))
+        for fn in self._listeners: fn(ts, chat_id, text)
+        return web.json_response({"ok": True, "result": {"message_id": len(self.sent), "date": int(ts),
+                                                          "chat": {"id": chat_id}, "text": text}})
+
+    async def _m_getUpdates(self, params, n):
+        timeout = float(params.get("timeout", 0) or 0)
+        out = []
+        try:
+            out.append(await asyncio.wait_for(self._updates.get(), timeout) if timeout else self._updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            pass
+        while not self._updates.empty(): out.append(self._updates.get_nowait())
+        return web.json_response({"ok": True, "result": out})
+
+    async def _m_setWebhook(self, params, n):
+        self.webhook = params.get("url"); return web.json_response({"ok": True, "result": True})
+
+    async def _m_deleteWebhook(self, params, n):
+        self.webhook = None; return web.json_response({"ok": True, "result": True})
@@ -0,0 +1,155 @@
+import os, re, sys, json, time, random, asyncio, argparse, resource, tempfile, tracemalloc
+
+# Offline load test for the watcher hot path: synthetic NewMessage-like events go straight
+# into watcher's trigger handler, and every Bot API call lands on a local FakeBotApi.
+# No Telegram account, bot or network is needed.
+#
+#   python loadtest.py --rate 10000 --duration 10 --groups 100
+#   python loadtest.py --rate 2000 --api-latency-ms 80 --rate-limit-every 20 --json
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Offline load test for watcher.py")
+    ap.add_argument("--rate", type=float, default=10000, help="injected messages per second")
+    ap.add_argument("--duration", type=float, default=5.0, help="seconds of injection")
+    ap.add_argument("--groups", type=int, default=100, help="watched groups")
+    ap.add_argument("--targets", type=int, default=2, help="target users per group")
+    ap.add_argument("--subscribers", type=int, default=1, help="chats every alert fans out to")
+    ap.add_argument("--senders", type=int, default=5000, help="distinct non-target senders")
+    ap.add_argument("--target-ratio", type=float, default=0.001, help="share of messages posted by a target")
+    ap.add_argument("--unwatched-ratio", type=float, default=0.5, help="share of messages in chats nobody watches")
+    ap.add_argument("--api-latency-ms", type=float, default=30.0, help="fake Bot API latency per call")
+    ap.add_argument("--rate-limit-every", type=int, default=0, help="answer every Nth sendMessage with 429")
+    ap.add_argument("--chat-rate", type=float, default=None, help="override BOT_CHAT_RATE")
+    ap.add_argument("--coalesce-ms", type=int, default=None, help="override BOT_COALESCE_MS")
+    ap.add_argument("--burst-window", type=float, default=0.0, help="ALERT_COALESCE_SECONDS (0 = every trigger is forwarded)")
+    ap.add_argument("--archive", choices=("off", "triggers", "all"), default="off", help="feed a temporary FTS archive")
+    ap.add_argument("--drain-timeout", type=float, default=30.0, help="max seconds to wait for queued DMs")
+    ap.add_argument("--tracemalloc", action="store_true", help="also report peak Python heap (slower)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true", help="print the report as JSON")
+    return ap.parse_args()
+
+args = parse_args()
+# watcher reads its config at import time
+os.environ["STATE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="tgw-load-"), "state.json")
+if args.chat_rate is not None: os.environ["BOT_CHAT_RATE"] = str(args.chat_rate)
+if args.coalesce_ms is not None: os.environ["BOT_COALESCE_MS"] = str(args.coalesce_ms)
+os.environ["ALERT_COALESCE_SECONDS"] = str(args.burst_window)
+
+import watcher
+from fake_botapi import FakeBotApi, FakeEvent
+
+TOKEN_RE = re.compile(r"\blt#(\d+)\b")
+
+def pct(values, q):
+    if not values: return None
+    values = sorted(values); i = min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))
+    return values[i]
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KiB on Linux
+
+async def run():
+    rnd = random.Random(args.seed)
+    if args.tracemalloc: tracemalloc.start()
+    api = await FakeBotApi(latency_ms=args.api_latency_ms, rate_limit_every=args.rate_limit_every).start()
+    bot = await api.start_bot("loadtest")
+
+    index = watcher.WatchIndex()
+    groups = [-1000000000000 - g for g in range(1, args.groups + 1)]
+    unwatched = [-1009000000000 - g for g in range(1, args.groups + 1)]
+    targets = {}
+    for n, peer_id in enumerate(groups):
+        index.add_group(peer_id, f"Group {n}")
+        targets[peer_id] = [10_000_000 + n * args.targets + t for t in range(args.targets)]
+        for uid in targets[peer_id]: index.add_target(peer_id, uid, f"target{uid}")
+    senders = list(range(1, args.senders + 1))
+
+    subs = watcher.Subscribers(bot)
+    for chat_id in range(1, args.subscribers + 1): subs.add(chat_id)
+    alerts = watcher.AlertScheduler()
+    archive = None
+    if args.archive != "off":
+        archive = await watcher.Archive(os.path.join(os.path.dirname(os.environ["STATE_PATH"]), "archive.db"),
+                                        archive_all=args.archive == "all").start()
+    handler = watcher.build_trigger_handler(bot, index, alerts, subs=subs, archive=archive)
+    builder = watcher.RoutedNewMessage(index); await builder.resolve(None)  # the chat whitelist Telethon applies
+    nag_task = asyncio.create_task(alerts.run(*watcher.make_nag_callbacks(bot)))
+
+    origins = {}; latencies = []; seen = set()
+    @api.on_message
+    def on_dm(ts, chat_id, text):
+        for tok in TOKEN_RE.findall(text):
+            if tok in origins and (tok, chat_id) not in seen: seen.add((tok, chat_id)); latencies.append(ts - origins[tok])
+
+    injected = dropped = triggers = 0; handler_time = filter_time = 0.0
+    rss_before = rss_mb(); cpu0 = time.process_time(); t0 = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - t0
+        if elapsed >= args.duration: break
+        due = int(elapsed * args.rate) - injected - dropped
+        for _ in range(max(0, due)):
+            n = injected + dropped
+            if rnd.random() < args.unwatched_ratio:
+                ev = FakeEvent(rnd.choice(unwatched), rnd.choice(senders), f"chatter {n}", n)
+            else:
+                peer_id = rnd.choice(groups)
+                if rnd.random() < args.target_ratio:
+                    sender = rnd.choice(targets[peer_id]); text = f"lt#{n} target post"; origins[str(n)] = time.time(); triggers += 1
+                else:
+                    sender = rnd.choice(senders); text = f"chatter {n}"
+                ev = FakeEvent(peer_id, sender, text, n)
+            h0 = time.perf_counter()
+            if not builder.filter(ev):
+                filter_time += time.perf_counter() - h0; dropped += 1; continue  # dropped before the handler
+            await handler(ev); handler_time += time.perf_counter() - h0
+            injected += 1
+        await asyncio.sleep(0.001)
+    inject_wall = time.perf_counter() - t0; cpu = time.process_time() - cpu0
+
+    deadline = time.perf_counter() + args.drain_timeout
+    expected = len(origins) * args.subscribers
+    while len(seen) < expected and time.perf_counter() < deadline: await asyncio.sleep(0.05)
+    drain_wall = time.perf_counter() - t0 - inject_wall
+
+    peak_heap = tracemalloc.get_traced_memory()[1] / 2**20 if args.tracemalloc else None
+    nag_task.cancel(); alerts.stop()
+    archived = 0
+    if archive: await archive.close(); archived = archive.rows_written
+    await bot.close(); await api.stop()
+
+    total = injected + dropped
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "events": {"offered": total, "handled": injected, "dropped_unwatched": dropped, "triggers": triggers},
+        "throughput": {"offered_per_s": round(total / inject_wall, 1),
+                       "handler_us_per_event": round(1e6 * handler_time / max(1, injected), 2),
+                       "handler_capacity_per_s": round(injected / handler_time, 1) if handler_time else None,
+                       "filter_us_per_dropped": round(1e6 * filter_time / max(1, dropped), 2),
+                       "cpu_s": round(cpu, 3)},
+        "trigger_to_dm_ms": {"delivered": len(latencies), "lost": expected - len(seen),
+                             "p50": round(1000 * pct(latencies, 0.5), 1) if latencies else None,
+                             "p99": round(1000 * pct(latencies, 0.99), 1) if latencies else None,
+                             "max": round(1000 * max(latencies), 1) if latencies else None},
+        "archive_rows": archived,
+        "bot_api": {"calls": api.calls, "rate_limited": api.rate_limited, "messages": len(api.sent),
+                    "drain_s": round(drain_wall, 2)},
+        "memory_mb": {"max_rss_before": round(rss_before, 1), "max_rss_after": round(rss_mb(), 1),
+                      "peak_heap": round(peak_heap, 1) if peak_heap is not None else None},
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        e, t, l, b, m = report["events"], report["throughput"], report["trigger_to_dm_ms"], report["bot_api"], report["memory_mb"]
+        print(f"== Load test: {args.rate:g} msg/s for {args.duration:g}s across {args.groups} groups, {args.subscribers} subscriber(s) ==")
+        print(f"Events: {e['offered']} offered, {e['handled']} handled, {e['dropped_unwatched']} unwatched, {e['triggers']} triggers")
+        print(f"Throughput: {t['offered_per_s']} msg/s offered, {t['handler_us_per_event']} µs/event in handler "
+              f"(capacity ≈ {t['handler_capacity_per_s']} msg/s), {t['filter_us_per_dropped']} µs per dropped event, CPU {t['cpu_s']}s")
+        print(f"Trigger→DM: p50 {l['p50']} ms, p99 {l['p99']} ms, max {l['max']} ms, delivered {l['delivered']}, lost {l['lost']}")
+        print(f"Bot API: {b['messages']} messages, {b['rate_limited']} × 429, calls {b['calls']}, drained in {b['drain_s']}s")
+        print(f"Memory: max RSS {m['max_rss_before']} → {m['max_rss_after']} MB" + (f", peak heap {m['peak_heap']} MB" if m['peak_heap'] is not None else ""))
+    return report
+
+if __name__ == "__main__":
+    report = asyncio.run(run())
+    sys.exit(1 if report["trigger_to_dm_ms"]["lost"] else 0)
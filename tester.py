@@ -1,7 +1,8 @@
-import os, json, time, asyncio
+import os, re, sys, json, time, random, asyncio, argparse, tempfile
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 import aiohttp
-from telethon import TelegramClient
+from telethon import TelegramClient, events
 from telethon.sessions import StringSession
 from telethon.tl.types import Chat, Channel
 from telethon.utils import get_peer_id
@@ -15,6 +16,29 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 GROUP_INVITE = os.getenv("GROUP_INVITE", "").strip()
 STATE_PATH = os.getenv("STATE_PATH", "state.json")
 BOT_CHAT_ID_ENV = os.getenv("BOT_CHAT_ID", "").strip()
+# probe mode: optional second account that is also subscribed to the watcher's DMs
+PROBE_SESSION = os.getenv("PROBE_SESSION", "").strip()
+
+# Probe mode sends --count tagged messages at --rate per second and matches every DM the
+# watcher sends back to its message by token:
+#
+#   python tester.py --probe --count 20 --rate 1          # live: your account posts, your DMs are read
+#   python tester.py --probe --fake --count 500 --rate 50 # offline: watcher handler + fake_botapi.py
+#
+# The report (p50/p95/p99 latency, lost, duplicates) is printed as JSON; the exit code is
+# non-zero on any loss or duplicate, or when p99 exceeds --max-p99-ms.
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Watcher self-test and end-to-end latency probe")
+    ap.add_argument("--probe", action="store_true", help="send tagged messages and measure message→DM latency")
+    ap.add_argument("--fake", action="store_true", help="probe offline against fake_botapi.py (no Telegram needed)")
+    ap.add_argument("--count", type=int, default=20, help="probe messages to send")
+    ap.add_argument("--rate", type=float, default=1.0, help="probe messages per second")
+    ap.add_argument("--wait", type=float, default=60.0, help="seconds to wait for DMs after the last send")
+    ap.add_argument("--max-p99-ms", type=float, default=None, help="fail if p99 latency is above this")
+    ap.add_argument("--redeliver", type=float, default=0.1, help="--fake: share of events delivered twice (dedupe check)")
+    ap.add_argument("--api-latency-ms", type=float, default=30.0, help="--fake: Bot API latency per call")
+    return ap.parse_args()
 
 def fail(msg): print("❌", msg); raise SystemExit(1)
 
@@ -59,6 +83,9 @@ async def main():
             try:
                 s = json.load(open(STATE_PATH,"r",encoding="utf-8"))
                 ident = s.get("group_link","")
+                if not ident and s.get("groups"):
+                    cur = str(s.get("current_group") or next(iter(s["groups"])))
+                    ident = s["groups"].get(cur, {}).get("link") or int(cur)
             except: pass
     if not ident: fail("No GROUP_INVITE or saved group_link. Set one, or /setgroup in bot chat.")
 
@@ -84,5 +111,128 @@ async def main():
     print("👉 Watcher should DM you (forwarded message) and start nagging.")
     print("== Tester finished ==")
 
+# --- Probe ---
+class Probe:
+    """Tags outgoing messages with "probe#<run>-<n>" and matches incoming DMs to them."""
+    def __init__(self, count: int):
+        self.run = f"{random.randrange(16**6):06x}"
+        self.pattern = re.compile(rf"probe#{self.run}-(\d+)\b")
+        self.count = count
+        self.sent_at = {}; self.latency = {}; self.duplicates = 0
+    def text(self, n: int) -> str:
+        self.sent_at[n] = time.monotonic()
+        return f"[SELFTEST] probe#{self.run}-{n} sent {datetime.now(timezone.utc):%H:%M:%S.%f}"
+    def seen(self, text: str):
+        now = time.monotonic()
+        for n in {int(m) for m in self.pattern.findall(text or "")}:  # a packed DM carries several
+            if n not in self.sent_at: continue
+            if n in self.latency: self.duplicates += 1
+            else: self.latency[n] = now - self.sent_at[n]
+    def done(self) -> bool:
+        return len(self.latency) >= self.count
+    async def wait(self, seconds: float):
+        deadline = time.monotonic() + seconds
+        while not self.done() and time.monotonic() < deadline: await asyncio.sleep(0.05)
+    def report(self, mode: str, **config) -> dict:
+        values = sorted(self.latency.values())
+        def pct(q):
+            if not values: return None
+            return round(1000 * values[min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))], 1)
+        return {"mode": mode, "run": self.run, "config": config,
+                "sent": len(self.sent_at), "received": len(self.latency),
+                "lost": len(self.sent_at) - len(self.latency), "duplicates": self.duplicates,
+                "latency_ms": {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99),
+                               "max": round(1000 * values[-1], 1) if values else None}}
+
+async def probe_live(args) -> dict:
+    # your account posts into the watched group and reads the bot's DMs; with PROBE_SESSION
+    # a second (subscribed) account reads them instead
+    if not API_ID or not API_HASH: fail("Missing TELEGRAM_API_ID / TELEGRAM_API_HASH")
+    if not BOT_TOKEN: fail("Missing BOT_TOKEN")
+    if not GROUP_INVITE: fail("Probe mode needs GROUP_INVITE (the group the watcher should watch).")
+    async with aiohttp.ClientSession() as http:
+        bot_me = await bot_call(http, "getMe")
+    session = StringSession(STRING_SESSION) if STRING_SESSION else SESSION_FILE
+    client = TelegramClient(session, API_ID, API_HASH); await client.start()
+    listener = client
+    if PROBE_SESSION:
+        listener = TelegramClient(StringSession(PROBE_SESSION) if len(PROBE_SESSION) > 100 else PROBE_SESSION, API_ID, API_HASH)
+        await listener.start()
+    undo = []
+    try:
+        me_user = await client.get_me()
+        ent = await client.get_entity(int(GROUP_INVITE) if GROUP_INVITE.lstrip("-").isdigit() else GROUP_INVITE)
+        if not isinstance(ent, (Chat, Channel)): fail("Resolved entity is not a group/supergroup.")
+        peer_id = get_peer_id(ent)
+        # the watcher's saved routes tell what the probe adds; without a state file assume both
+        routes, current = {}, None
+        if os.path.exists(STATE_PATH):
+            try:
+                st = json.load(open(STATE_PATH, "r", encoding="utf-8"))
+                routes, current = st.get("routes") or {}, st.get("current_group")
+            except: pass
+        # undo only what the probe adds; removing the target/group also ends every subscriber's nags
+        if me_user.id in routes.get(str(peer_id), []): undo.append(f"/stop {peer_id}")
+        else: undo.append(f"/setuser del {me_user.id} {peer_id}")
+        if str(peer_id) not in routes: undo.append(f"/usegroup del {peer_id}")
+        if current and current != peer_id: undo.append(f"/usegroup {current}")  # reselect the old group
+
+        probe = Probe(args.count)
+        listener.add_event_handler(lambda ev: probe.seen(ev.raw_text), events.NewMessage(chats=bot_me["id"], incoming=True))
+        # commands go to the bot as real updates, so the watcher watches this account
+        for cmd in ("/start", f"/usegroup {peer_id}", f"/setuser {me_user.id} {peer_id}"):
+            await client.send_message(bot_me["username"], cmd)
+        await asyncio.sleep(3)
+        for n in range(args.count):
+            await client.send_message(ent, probe.text(n))
+            await asyncio.sleep(1.0 / args.rate)
+        await probe.wait(args.wait)
+        await asyncio.sleep(2)  # let late duplicates arrive
+        return probe.report("live", count=args.count, rate=args.rate, group=peer_id,
+                            listener="second account" if PROBE_SESSION else "own account")
+    finally:
+        try:
+            for cmd in undo: await client.send_message(bot_me["username"], cmd)
+        except Exception as e: print(f"⚠️  Probe cleanup failed ({e}); send {undo} to the bot by hand.")
+        if listener is not client: await listener.disconnect()
+        await client.disconnect()
+
+async def probe_fake(args) -> dict:
+    # the watcher's own trigger handler, outbox and HTTP client against a local Bot API;
+    # DMs are read from the sendMessage calls fake_botapi.py accepts, so no account is needed
+    os.environ["STATE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="tgw-probe-"), "state.json")
+    os.environ["ALERT_COALESCE_SECONDS"] = "0"  # every probe message is forwarded on its own
+    import watcher  # reads its config at import time
+    from fake_botapi import FakeBotApi, FakeEvent
+    api = await FakeBotApi(latency_ms=args.api_latency_ms).start()
+    bot = await api.start_bot("probe")
+    peer_id, target, target_name = -1001234567890, 42, "probe_target"
+    index = watcher.WatchIndex(); index.add_group(peer_id, "Probe group"); index.add_target(peer_id, target, target_name)
+    alerts = watcher.AlertScheduler()
+    handler = watcher.build_trigger_handler(bot, index, alerts)
+    probe = Probe(args.count)
+    api.on_message(lambda ts, chat_id, text: probe.seen(text))
+    rnd = random.Random(1)
+    try:
+        for n in range(args.count):
+            ev = FakeEvent(peer_id, target, probe.text(n), n + 1, target_name)
+            await handler(ev)
+            if rnd.random() < args.redeliver: await handler(ev)  # same update twice, as after a reconnect
+            await asyncio.sleep(1.0 / args.rate)
+        await probe.wait(args.wait)
+        await asyncio.sleep(0.5)
+    finally:
+        alerts.stop(); await bot.close(); await api.stop()
+    return probe.report("fake", count=args.count, rate=args.rate, api_latency_ms=args.api_latency_ms, redeliver=args.redeliver)
+
+async def run_probe(args) -> int:
+    report = await (probe_fake(args) if args.fake else probe_live(args))
+    print(json.dumps(report, indent=2))
+    p99 = report["latency_ms"]["p99"]
+    slow = args.max_p99_ms is not None and (p99 is None or p99 > args.max_p99_ms)
+    return 1 if report["lost"] or report["duplicates"] or slow else 0
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.probe: sys.exit(asyncio.run(run_probe(args)))
     asyncio.run(main())
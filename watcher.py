@@ -2,14 +2,31 @@ import os
 import time
 import asyncio
 import json
-from typing import Optional, List, Dict, Any
+import re
+import bisect
+import heapq
+import hmac
+import itertools
+import random
+import secrets
+import sqlite3
+import tempfile
+import contextvars
+from collections import OrderedDict, deque
+from typing import Optional, List, Dict, Any, Set
+from urllib.parse import urlparse
+from datetime import datetime
+from zoneinfo import ZoneInfo
 
 from dotenv import load_dotenv
 from telethon import TelegramClient, events
 from telethon.sessions import StringSession
-from telethon.tl.types import User, Chat, Channel
-from telethon.utils import get_peer_id
+from telethon.tl.types import User, Chat, Channel, InputPeerUser, InputPeerChat, InputPeerChannel, PeerChannel, PeerChat
+from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument
+from telethon.utils import get_peer_id, get_input_peer, resolve_id
+from telethon.errors import FloodWaitError, ServerError, TimedOutError
 import aiohttp
+from aiohttp import web
 
 load_dotenv()
 
@@ -18,12 +35,26 @@ API_ID = int(os.getenv("TELEGRAM_API_ID", "0"))
 API_HASH = os.getenv("TELEGRAM_API_HASH", "")
 SESSION_FILE = os.getenv("TELEGRAM_SESSION", "telegram_session")
 STRING_SESSION = os.getenv("TELEGRAM_STRING_SESSION", "").strip()
+# more accounts (string sessions or session file names, comma-separated): watched groups are
+# split across all of them; the main session above also resolves bot commands
+EXTRA_SESSIONS = [x.strip() for x in os.getenv("TELEGRAM_EXTRA_SESSIONS", "").split(",") if x.strip()]
+SHARD_FLOOD_SLEEP = int(os.getenv("SHARD_FLOOD_SLEEP", "5"))  # longer FloodWaits move a shard's groups away
 
 GROUP_INVITE = os.getenv("GROUP_INVITE", "").strip()
 TARGET_USERNAME = os.getenv("TARGET_USERNAME", "").lstrip("@")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 BOT_CHAT_ID_ENV = os.getenv("BOT_CHAT_ID", "").strip()
+# chats allowed to subscribe and run commands, besides BOT_CHAT_ID; with neither set, the first /start owns the bot
+ALLOWED_CHAT_IDS = {int(x) for x in os.getenv("ALLOWED_CHAT_IDS", "").replace(" ", "").split(",") if x.lstrip("-").isdigit()}
+BOT_API_BASE = os.getenv("BOT_API_BASE", "https://api.telegram.org").rstrip("/")
+
+# how the bot receives commands: "polling" (getUpdates) or "webhook" (Telegram pushes to WEBHOOK_URL)
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or secrets.token_urlsafe(32)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8080")
 
 NAG_INTERVAL_SECONDS = int(os.getenv("NAG_INTERVAL_SECONDS", "300"))
 DEFAULT_NAG_INTERVAL_SECONDS = NAG_INTERVAL_SECONDS
@@ -32,16 +63,62 @@ NAG_MESSAGE_TEMPLATE = os.getenv(
     "🚨 ALERT: {who} just posted in {where}. Open Telegram now and register if needed. Reply /stop to this bot to stop alerts."
 )
 MAX_NAGS = int(os.getenv("MAX_NAGS", "0"))
+DEFAULT_MAX_NAGS = MAX_NAGS
 
 KEYWORDS_RAW = os.getenv("REQUIRED_KEYWORDS", "").strip()
 REQUIRED_KEYWORDS: List[str] = [k.strip().lower() for k in KEYWORDS_RAW.split(",") if k.strip()]
+RULES_TZ = os.getenv("RULES_TZ", "").strip()  # zone for "hours" rules; empty = server local time
 
 STATE_PATH = os.getenv("STATE_PATH", "state.json")
+STATE_BACKEND = os.getenv("STATE_BACKEND", "").strip().lower() or (
+    "sqlite" if STATE_PATH.endswith((".db", ".sqlite", ".sqlite3")) else "json")
+STATE_SAVE_DELAY_MS = int(os.getenv("STATE_SAVE_DELAY_MS", "500"))
+COMMAND_CONCURRENCY = int(os.getenv("COMMAND_CONCURRENCY", "4"))
+COMMAND_TIMEOUT = float(os.getenv("COMMAND_TIMEOUT", "30"))  # max Telegram lookup in an ordered command
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = no Prometheus endpoint
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "5000"))
+
+# media relay: files are streamed chunk by chunk from Telegram into a Bot API upload
+MEDIA_FORWARD = os.getenv("MEDIA_FORWARD", "1").strip().lower() not in ("0", "false", "no", "off")
+MEDIA_MAX_BYTES = int(float(os.getenv("MEDIA_MAX_MB", "50")) * 2**20)  # Bot API upload limit is 50 MB
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", "2"))
+MEDIA_CHUNK_BYTES = 512 * 1024  # Telethon's largest download request
+BOT_PHOTO_LIMIT = 10 * 2**20  # bigger photos go out as documents
+
+# local full-text archive (SQLite FTS5) behind /search and /last; empty ARCHIVE_PATH = off
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "archive.db").strip()
+ARCHIVE_ALL = os.getenv("ARCHIVE_ALL", "0").strip().lower() in ("1", "true", "yes", "on")  # every message, not just triggers
+ARCHIVE_RETENTION_DAYS = float(os.getenv("ARCHIVE_RETENTION_DAYS", "30"))  # 0 = keep forever
+ARCHIVE_BATCH_MS = int(os.getenv("ARCHIVE_BATCH_MS", "500"))
+
+# gap recovery: after a restart/reconnect, replay up to this many missed messages per group (0 = off)
+BACKFILL_LIMIT = int(os.getenv("BACKFILL_LIMIT", "500"))
+
+# outbound Bot API pacing (Telegram allows ~1 msg/s per chat, ~30 msg/s overall)
+BOT_CHAT_RATE = float(os.getenv("BOT_CHAT_RATE", "1.0"))
+BOT_CHAT_BURST = float(os.getenv("BOT_CHAT_BURST", "3"))
+BOT_GLOBAL_RATE = float(os.getenv("BOT_GLOBAL_RATE", "25"))
+BOT_COALESCE_MS = int(os.getenv("BOT_COALESCE_MS", "250"))
+ALERT_COALESCE_SECONDS = float(os.getenv("ALERT_COALESCE_SECONDS", "30"))  # burst window per group/target (0 = off)
+DIGEST_MAX_ITEMS = 100
+BOT_SEND_CONCURRENCY = int(os.getenv("BOT_SEND_CONCURRENCY", "8"))  # chats with a send in flight at once
+DELIVERY_LOG_SIZE = 32  # recent (time, status) records kept per chat
+BOT_MESSAGE_LIMIT = 4096
 
-if not API_ID or not API_HASH:
-    raise SystemExit("Please set TELEGRAM_API_ID and TELEGRAM_API_HASH.")
-if not BOT_TOKEN:
-    raise SystemExit("Please set BOT_TOKEN from @BotFather.")
+# supervisor: every loop is restarted with jittered exponential backoff; liveness probes on a timer
+PROBE_INTERVAL_SECONDS = float(os.getenv("PROBE_INTERVAL_SECONDS", "30"))  # 0 = no probes
+PROBE_TIMEOUT_SECONDS = float(os.getenv("PROBE_TIMEOUT_SECONDS", "10"))
+BACKOFF_MAX_SECONDS = float(os.getenv("BACKOFF_MAX_SECONDS", "60"))
+
+def check_config():
+    # checked when the watcher starts, so loadtest.py can import this module without credentials
+    if not API_ID or not API_HASH:
+        raise SystemExit("Please set TELEGRAM_API_ID and TELEGRAM_API_HASH.")
+    if not BOT_TOKEN:
+        raise SystemExit("Please set BOT_TOKEN from @BotFather.")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL (the public https URL Telegram should POST to).")
 
 # --- Utils ---
 def extract_invite_hash(link: str):
@@ -90,338 +167,2138 @@ def safe_slice(text: str, max_len: int = 3600) -> str:
         return ""
     return text if len(text) <= max_len else text[:max_len - 20] + "\n…(truncated)"
 
+# --- Metrics ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets; self.counts = [0] * (len(buckets) + 1); self.sum = 0.0; self.count = 0
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1; self.sum += value; self.count += 1
+    def quantile(self, q: float) -> float:
+        # linear interpolation inside the bucket holding the q-th observation
+        if not self.count: return 0.0
+        rank = q * self.count; seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lo = self.buckets[i - 1] if i else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+class Metrics:
+    """In-process counters, latency histograms and gauges, rendered as Prometheus text."""
+    def __init__(self):
+        self.counters: Dict[tuple, float] = {}
+        self.histograms: Dict[tuple, Histogram] = {}
+        self.gauges: Dict[str, Any] = {}
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None: h = self.histograms[key] = Histogram()
+        h.observe(value)
+    def gauge(self, name: str, fn):
+        self.gauges[name] = fn  # evaluated at scrape time
+    @staticmethod
+    def _labels(labels, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
+    def render(self) -> str:
+        out = []; typed = set()
+        for (name, labels), v in sorted(self.counters.items()):
+            if name not in typed: out.append(f"# TYPE tgw_{name} counter"); typed.add(name)
+            out.append(f"tgw_{name}{self._labels(labels)} {v:g}")
+        for (name, labels), h in sorted(self.histograms.items()):
+            if name not in typed: out.append(f"# TYPE tgw_{name} histogram"); typed.add(name)
+            cum = 0
+            for le, c in zip(list(h.buckets) + ["+Inf"], h.counts):
+                cum += c; le_label = f'le="{le}"'
+                out.append(f"tgw_{name}_bucket{self._labels(labels, le_label)} {cum}")
+            out.append(f"tgw_{name}_sum{self._labels(labels)} {h.sum:.6f}")
+            out.append(f"tgw_{name}_count{self._labels(labels)} {h.count}")
+        for name, fn in sorted(self.gauges.items()):
+            out.append(f"# TYPE tgw_{name} gauge"); out.append(f"tgw_{name} {fn():g}")
+        return "\n".join(out) + "\n"
+    def summary(self) -> str:
+        lines = []
+        for (name, labels), v in sorted(self.counters.items()):
+            lines.append(f"{name}{self._labels(labels)} = {v:g}")
+        for (name, labels), h in sorted(self.histograms.items()):
+            lines.append(f"{name}{self._labels(labels)}: n={h.count} p50={h.quantile(0.5)*1000:.0f}ms p99={h.quantile(0.99)*1000:.0f}ms")
+        for name, fn in sorted(self.gauges.items()):
+            lines.append(f"{name} = {fn():g}")
+        return "\n".join(lines) or "No metrics yet."
+
+METRICS = Metrics()
+
+async def serve_metrics(host: str, port: int) -> web.AppRunner:
+    async def scrape(request: web.Request):
+        return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8")
+    app = web.Application(); app.router.add_get("/metrics", scrape)
+    runner = web.AppRunner(app); await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"[METRICS] Prometheus endpoint on http://{host}:{port}/metrics")
+    return runner
+
+def pack_messages(texts: List[str], limit: int = BOT_MESSAGE_LIMIT):
+    """Join queued texts into one message of at most `limit` chars; returns (chunk, rest)."""
+    chunk = safe_slice(texts[0], limit); n = 1
+    while n < len(texts) and len(chunk) + 2 + len(texts[n]) <= limit:
+        chunk += "\n\n" + texts[n]; n += 1
+    return chunk, texts[n:]
+
+def split_message(header: str, lines: List[str], limit: int = BOT_MESSAGE_LIMIT) -> List[str]:
+    """Split header + lines into messages of at most `limit` chars, never cutting a line."""
+    parts: List[str] = []; cur = header
+    for line in lines:
+        line = safe_slice(line, limit - len(header) - 16)
+        if len(cur) + 1 + len(line) > limit: parts.append(cur); cur = f"{header} (cont.)"
+        cur += "\n" + line
+    parts.append(cur)
+    return parts
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(rate, 1e-6); self.burst = max(burst, 1.0)
+        self.tokens = self.burst; self.stamp = time.monotonic()
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate); self.stamp = now
+    def ready_at(self, now: float) -> float:
+        self._refill(now)
+        return now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+    def take(self, now: float):
+        self._refill(now); self.tokens -= 1
+
+class Backoff:
+    """Exponential backoff with jitter: the n-th delay is uniform in [base/4, min(cap, base * 2**n)]."""
+    def __init__(self, base: float = 1.0, cap: float = BACKOFF_MAX_SECONDS):
+        self.base = base; self.cap = max(cap, base); self.attempt = 0
+    def next(self) -> float:
+        ceiling = min(self.cap, self.base * 2 ** self.attempt); self.attempt += 1
+        return random.uniform(self.base / 4, ceiling)
+    def reset(self):
+        self.attempt = 0
+
+class BotApiError(RuntimeError):
+    def __init__(self, method: str, status: int, data: Any):
+        self.method = method; self.status = status
+        params = data.get("parameters") if isinstance(data, dict) else None
+        self.retry_after: Optional[float] = (params or {}).get("retry_after")
+        super().__init__(f"Bot {method} HTTP {status}: {data}" if status != 200 else f"Bot {method} failed: {data}")
+    @property
+    def fatal(self) -> bool:
+        # 401/404: bad or revoked token; 400/403: this exact request will never succeed (bad chat, bot blocked)
+        return self.status in (400, 401, 403, 404)
+
+def is_transient(err: BaseException) -> bool:
+    """True for failures that heal by themselves (network, timeouts, 5xx, 409, 429, FloodWait)."""
+    if isinstance(err, BotApiError): return not err.fatal
+    return isinstance(err, (FloodWaitError, ServerError, TimedOutError, aiohttp.ClientError,
+                            asyncio.TimeoutError, ConnectionError, OSError))
+
+# --- State store ---
+# snapshot() runs on the event loop (consistent view, cheap json.dumps);
+# write() does the blocking I/O and is run in a worker thread.
+class JsonStateStore:
+    def __init__(self, path: str):
+        self.path = path
+    def load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f: return json.load(f)
+        except FileNotFoundError: return {}
+        except ValueError as e:
+            print(f"[STATE][WARN] {self.path} is unreadable ({e}); starting empty."); return {}
+    def snapshot(self, data: Dict[str, Any], changed: Optional[Set[str]]) -> str:
+        return json.dumps(data, ensure_ascii=False, indent=2)
+    def write(self, payload: str):
+        # temp file + fsync + rename: a crash leaves either the old or the new file, never half of one
+        fd, tmp = tempfile.mkstemp(prefix=".state-", suffix=".tmp", dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(payload); f.flush(); os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            try: os.unlink(tmp)
+            except OSError: pass
+            raise
+    def close(self): pass
+
+class SqliteStateStore:
+    """One row per top-level state key in WAL mode, so a save only rewrites the keys that changed."""
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._conn = conn
+        return self._conn
+    def load(self) -> Dict[str, Any]:
+        return {k: json.loads(v) for k, v in self._db().execute("SELECT key, value FROM state")}
+    def snapshot(self, data: Dict[str, Any], changed: Optional[Set[str]]):
+        keys = data.keys() if changed is None else changed
+        rows = [(k, json.dumps(data[k], ensure_ascii=False) if k in data else None) for k in keys]
+        return rows, (list(data) if changed is None else None)
+    def write(self, payload):
+        rows, keep = payload
+        with self._db() as db:
+            for k, v in rows:
+                if v is None: db.execute("DELETE FROM state WHERE key = ?", (k,))
+                else: db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (k, v))
+            if keep is not None:
+                db.execute(f"DELETE FROM state WHERE key NOT IN ({','.join('?' * len(keep))})", keep)
+    def close(self):
+        if self._conn: self._conn.close(); self._conn = None
+
+def open_state_store(path: str, backend: str = STATE_BACKEND):
+    return SqliteStateStore(path) if backend == "sqlite" else JsonStateStore(path)
+
+# --- Archive ---
+class Archive:
+    """Messages in SQLite with an external-content FTS5 index. add() only appends to an
+    in-memory batch; a writer task flushes it every ARCHIVE_BATCH_MS in a worker thread
+    and prunes expired rows a bounded chunk at a time. Upserts on (peer_id, msg_id), so
+    edits replace the text and a message archived before it triggered gets flagged."""
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY, peer_id INTEGER NOT NULL, msg_id INTEGER NOT NULL, sender_id INTEGER,
+        date INTEGER NOT NULL, triggered INTEGER NOT NULL DEFAULT 0, text TEXT NOT NULL, UNIQUE (peer_id, msg_id));
+    CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+    CREATE INDEX IF NOT EXISTS messages_triggered ON messages (triggered, date);
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+    CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END;
+    CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text); END;
+    CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END;
+    """
+    UPSERT = ("INSERT INTO messages (peer_id, msg_id, sender_id, date, triggered, text) VALUES (?, ?, ?, ?, ?, ?) "
+              "ON CONFLICT (peer_id, msg_id) DO UPDATE SET text = excluded.text, "
+              "triggered = max(triggered, excluded.triggered)")
+    PRUNE_CHUNK = 1000
+    def __init__(self, path: str, archive_all: bool = ARCHIVE_ALL, retention_days: float = ARCHIVE_RETENTION_DAYS,
+                 batch_ms: int = ARCHIVE_BATCH_MS):
+        self.path = path; self.archive_all = archive_all
+        self.retention = retention_days * 86400; self.batch_s = batch_ms / 1000.0
+        self._pending: List[tuple] = []
+        self._wconn: Optional[sqlite3.Connection] = None
+        self._rconn: Optional[sqlite3.Connection] = None
+        self._write_lock = asyncio.Lock(); self._read_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._last_prune = 0.0
+        self.rows_written = 0
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    def _open(self):
+        if self._wconn is None:
+            self._wconn = self._connect(); self._wconn.executescript(self.SCHEMA)
+            self._rconn = self._connect()
+    async def start(self):
+        await asyncio.to_thread(self._open)
+        if self._task is None: self._task = asyncio.create_task(self._writer())
+        return self
+    def add(self, peer_id: int, msg_id: int, sender_id: Optional[int], date: Optional[datetime], text: str, triggered: bool):
+        self._pending.append((peer_id, msg_id, sender_id, int(date.timestamp()) if date else int(time.time()),
+                              1 if triggered else 0, text))
+        if len(self._pending) == 1: self._wakeup.set()
+    def _write(self, rows: List[tuple]):
+        with self._wconn as db: db.executemany(self.UPSERT, rows)
+    def _prune(self, cutoff: int) -> int:
+        with self._wconn as db:
+            n = db.execute("DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE date < ? ORDER BY date LIMIT ?)",
+                           (cutoff, self.PRUNE_CHUNK)).rowcount
+        return n
+    async def flush(self):
+        async with self._write_lock:
+            if not self._pending: return
+            rows, self._pending = self._pending, []
+            t0 = time.perf_counter()
+            try: await asyncio.to_thread(self._write, rows)
+            except Exception as e: print(f"[ARCHIVE][ERROR] {e}"); return
+            self.rows_written += len(rows)
+            METRICS.observe("archive_flush_seconds", time.perf_counter() - t0); METRICS.inc("archive_rows_total", len(rows))
+    async def _writer(self):
+        while True:
+            self._wakeup.clear()
+            if not self._pending:
+                try: await asyncio.wait_for(self._wakeup.wait(), 60.0)
+                except asyncio.TimeoutError: pass
+            await asyncio.sleep(self.batch_s)  # let the batch fill up
+            await self.flush()
+            if self.retention and time.monotonic() - self._last_prune >= 60.0:
+                self._last_prune = time.monotonic()
+                async with self._write_lock:
+                    try:
+                        n = await asyncio.to_thread(self._prune, int(time.time() - self.retention))
+                        if n: METRICS.inc("archive_pruned_total", n)
+                        if n == self.PRUNE_CHUNK: self._last_prune = 0.0  # more to go: next round
+                    except Exception as e: print(f"[ARCHIVE][ERROR] prune: {e}")
+    async def _query(self, sql: str, params: tuple) -> List[tuple]:
+        async with self._read_lock:
+            return await asyncio.to_thread(lambda: self._rconn.execute(sql, params).fetchall())
+    async def search(self, query: str, limit: int = 10) -> List[tuple]:
+        # (peer_id, msg_id, sender_id, date, snippet); plain words if the FTS syntax is invalid
+        sql = ("SELECT m.peer_id, m.msg_id, m.sender_id, m.date, snippet(messages_fts, 0, '«', '»', '…', 16) "
+               "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+               "WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?")
+        try: return await self._query(sql, (query, limit))
+        except sqlite3.OperationalError:
+            quoted = " ".join('"' + w.replace('"', '""') + '"' for w in query.split())
+            return await self._query(sql, (quoted, limit)) if quoted else []
+    async def last(self, n: int = 5, triggered_only: bool = True) -> List[tuple]:
+        where = "WHERE triggered = 1 " if triggered_only else ""
+        return await self._query(f"SELECT peer_id, msg_id, sender_id, date, text FROM messages {where}"
+                                 "ORDER BY date DESC, id DESC LIMIT ?", (n,))
+    async def close(self):
+        if self._task:
+            async with self._write_lock: self._task.cancel()  # lets an in-flight write finish first
+            self._task = None
+        await self.flush()
+        for conn in (self._wconn, self._rconn):
+            if conn: conn.close()
+        self._wconn = self._rconn = None
+
 # --- Bot (polling) ---
+# chat of the bot command being handled: replies without an explicit chat_id go there
+REPLY_TO: "contextvars.ContextVar[Optional[int]]" = contextvars.ContextVar("REPLY_TO", default=None)
+
 class SimpleBot:
     def __init__(self, token: str, state_path: str, chat_id_env: str = ""):
         self.token = token
-        self.base = f"https://api.telegram.org/bot{token}"
+        self.base = f"{BOT_API_BASE}/bot{token}"
         self.state_path = state_path
         self.session: Optional[aiohttp.ClientSession] = None
         self.update_offset = None
+        self._seen_updates: "OrderedDict[int, None]" = OrderedDict()  # webhook retries can redeliver
+        self._update_tasks: Set[asyncio.Task] = set()
         self.chat_id: Optional[int] = None
         self.state: Dict[str, Any] = {}
+        # outbox: chat_id -> queued texts, drained by a single worker (see _outbox_loop)
+        self._outbox: Dict[int, List[tuple]] = {}  # (text, origin wall-clock timestamps for latency metrics)
+        self._first_at: Dict[int, float] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._global_bucket = TokenBucket(BOT_GLOBAL_RATE, BOT_GLOBAL_RATE)
+        self._retry_until: Dict[int, float] = {}
+        self._backoff: Dict[int, Backoff] = {}  # chats whose last send hit a network error or 5xx
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        # one sendMessage in flight per chat (keeps its order), BOT_SEND_CONCURRENCY chats at once
+        self._sending: Set[int] = set()
+        self._send_slots = asyncio.Semaphore(max(1, BOT_SEND_CONCURRENCY))
+        self._send_tasks: Set[asyncio.Task] = set()
+        self.deliveries: Dict[int, "deque[tuple]"] = {}  # chat_id -> recent (unix time, "ok" | http status | "network")
+        # write-behind state: _save_state() marks keys dirty, _flush_later() writes them in a thread
+        self.store = open_state_store(state_path)
+        self._state_loaded = False
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
         if chat_id_env:
             try: self.chat_id = int(chat_id_env)
             except: pass
-        self._load_state()
-    def _load_state(self):
+    async def _load_state(self):
+        if self._state_loaded: return
         try:
-            data = json.load(open(self.state_path, "r", encoding="utf-8"))
+            data = await asyncio.to_thread(self.store.load)
             if self.chat_id is None and data.get("bot_chat_id"): self.chat_id = int(data["bot_chat_id"])
             self.state.update({k:v for k,v in data.items() if k != "bot_chat_id"})
-        except Exception:
-            pass
-    def _save_state(self):
-        data = {"bot_chat_id": self.chat_id}; data.update(self.state)
-        json.dump(data, open(self.state_path,"w",encoding="utf-8"), ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"[STATE][WARN] Could not load state: {e}")
+        self._state_loaded = True
+    def _save_state(self, *keys: str):
+        # debounced: bursts of changes collapse into one write STATE_SAVE_DELAY_MS later
+        self._dirty.update(keys or ("*",))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+    async def _flush_later(self):
+        await asyncio.sleep(STATE_SAVE_DELAY_MS / 1000.0)
+        await self.flush_state()
+    async def flush_state(self):
+        async with self._write_lock:
+            if not self._dirty: return
+            changed, self._dirty = self._dirty, set()
+            data = {"bot_chat_id": self.chat_id}; data.update(self.state)
+            payload = self.store.snapshot(data, None if "*" in changed else changed)
+            try: await asyncio.to_thread(self.store.write, payload)
+            except Exception as e:
+                print(f"[STATE][ERROR] Could not save state: {e}"); self._dirty |= changed
     async def start(self):
+        await self._load_state()
         if not self.session:
-            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=120))
-    async def close(self):
+            # one pooled connector: sends reuse keep-alive connections instead of a TLS handshake each
+            connector = aiohttp.TCPConnector(limit=16, keepalive_timeout=75, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120))
+        if not self._worker:
+            self._worker = asyncio.create_task(self._outbox_loop())
+    async def close(self, flush_timeout: float = 5.0):
+        if self._worker:
+            deadline = time.monotonic() + flush_timeout
+            while (self._outbox or self._sending) and time.monotonic() < deadline: await asyncio.sleep(0.05)
+            self._worker.cancel(); self._worker = None
+            for t in list(self._send_tasks): t.cancel()
+        if self._flush_task: self._flush_task.cancel(); self._flush_task = None
+        await self.flush_state()
+        self.store.close()
         if self.session:
             await self.session.close(); self.session=None
-    async def call(self, method: str, **params):
+    async def call(self, method: str, form: Optional[aiohttp.FormData] = None,
+                   http_timeout: Optional[aiohttp.ClientTimeout] = None, **params):
         url = f"{self.base}/{method}"
-        async with self.session.post(url, data=params) as resp:
-            text = await resp.text()
-            if resp.status != 200: raise RuntimeError(f"Bot {method} HTTP {resp.status}: {text}")
-            data = json.loads(text)
-            if not data.get("ok"): raise RuntimeError(f"Bot {method} failed: {data}")
-            return data["result"]
-    async def send_message(self, text: str):
-        if not self.chat_id:
+        t0 = time.perf_counter(); status = "network"
+        try:
+            async with self.session.post(url, data=form if form is not None else params,
+                                         timeout=http_timeout or self.session.timeout) as resp:
+                text = await resp.text(); status = resp.status
+                try: data = json.loads(text)
+                except ValueError: data = text
+                if resp.status != 200 or not isinstance(data, dict) or not data.get("ok"):
+                    raise BotApiError(method, resp.status, data)
+                status = "ok"
+                return data["result"]
+        finally:
+            METRICS.observe("bot_api_call_seconds", time.perf_counter() - t0, method=method)
+            if status != "ok": METRICS.inc("bot_api_errors_total", method=method, status=status)
+    def send_message(self, text: str, chat_id: Optional[int] = None, origin: Optional[float] = None):
+        # never blocks: the outbox worker does the HTTP.
+        # origin: wall-clock time of the event that caused this message (for trigger-to-DM latency)
+        chat_id = chat_id or REPLY_TO.get() or self.chat_id
+        if not chat_id:
             print("[BOT] No chat id yet. DM /start to register."); return
-        try: return await self.call("sendMessage", chat_id=self.chat_id, text=text)
-        except Exception as e: print(f"[BOT][ERROR] {e}")
+        self._outbox.setdefault(chat_id, []).append((text, (origin,) if origin else ()))
+        self._first_at.setdefault(chat_id, time.monotonic())
+        self._wakeup.set()
+    async def send_file(self, method: str, field: str, open_chunks, filename: str, mime: str,
+                        caption: str = "", chat_id: Optional[int] = None):
+        # multipart upload whose file part is an async iterator of chunks: aiohttp writes each
+        # chunk as it arrives, so nothing is buffered. open_chunks() is called again on a 429.
+        chat_id = chat_id or REPLY_TO.get() or self.chat_id
+        if not chat_id: return None
+        for attempt in range(3):
+            while True:
+                now = time.monotonic(); ready = max(self._ready_at(chat_id, now, coalesce=False), now)
+                if ready <= now: break
+                await asyncio.sleep(ready - now)
+            self._buckets[chat_id].take(now); self._global_bucket.take(now)
+            form = aiohttp.FormData()
+            form.add_field("chat_id", str(chat_id))
+            if caption: form.add_field("caption", safe_slice(caption, 1024))
+            form.add_field(field, open_chunks(), filename=filename, content_type=mime)
+            try:
+                res = await self.call(method, form=form, http_timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120))
+                self._record(chat_id, "ok"); return res
+            except BotApiError as e:
+                self._record(chat_id, str(e.status))
+                if not e.retry_after or attempt == 2: raise
+                METRICS.inc("bot_rate_limited_total")
+                self._retry_until[chat_id] = time.monotonic() + float(e.retry_after)
+    def _ready_at(self, chat_id: int, now: float, coalesce: bool = True) -> float:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None: bucket = self._buckets[chat_id] = TokenBucket(BOT_CHAT_RATE, BOT_CHAT_BURST)
+        return max(self._first_at.get(chat_id, now) + BOT_COALESCE_MS / 1000.0 if coalesce else 0.0,
+                   bucket.ready_at(now), self._global_bucket.ready_at(now),
+                   self._retry_until.get(chat_id, 0.0))
+    async def _outbox_loop(self):
+        while True:
+            waiting = [c for c in self._outbox if c not in self._sending]
+            if not waiting:
+                self._wakeup.clear(); await self._wakeup.wait(); continue
+            now = time.monotonic()
+            ready, chat_id = min((self._ready_at(c, now), c) for c in waiting)
+            if ready > now:
+                # sleep until the next chat is due, or until something new is queued/finished
+                self._wakeup.clear()
+                try: await asyncio.wait_for(self._wakeup.wait(), ready - now)
+                except asyncio.TimeoutError: pass
+                continue
+            await self._send_slots.acquire()
+            items = self._outbox.pop(chat_id, None); self._first_at.pop(chat_id, None)
+            if not items: self._send_slots.release(); continue
+            chunk, rest = pack_messages([t for t, _ in items])
+            packed = items[:len(items) - len(rest)]; origins = tuple(o for _, os_ in packed for o in os_)
+            if rest: self._outbox[chat_id] = items[len(packed):]; self._first_at[chat_id] = 0.0
+            now = time.monotonic(); self._buckets[chat_id].take(now); self._global_bucket.take(now)
+            self._sending.add(chat_id)
+            task = asyncio.create_task(self._deliver(chat_id, chunk, len(packed), origins))
+            self._send_tasks.add(task); task.add_done_callback(self._send_tasks.discard)
+    async def _deliver(self, chat_id: int, chunk: str, n: int, origins: tuple):
+        status = "network"
+        try:
+            await self.call("sendMessage", chat_id=chat_id, text=chunk)
+            status = "ok"; self._backoff.pop(chat_id, None)
+            METRICS.inc("bot_messages_sent_total"); METRICS.inc("bot_messages_coalesced_total", n - 1)
+            done = time.time()
+            for o in origins: METRICS.observe("trigger_to_dm_seconds", max(0.0, done - o))
+        except asyncio.CancelledError: raise
+        except Exception as e:
+            if isinstance(e, BotApiError): status = str(e.status)
+            if not is_transient(e): print(f"[BOT][ERROR] {e}"); return
+            # 429s wait what Telegram asks; outages back off per chat. Either way the text stays queued.
+            if getattr(e, "retry_after", None):
+                delay = float(e.retry_after); METRICS.inc("bot_rate_limited_total")
+            else:
+                backoff = self._backoff.get(chat_id)
+                if backoff is None: backoff = self._backoff[chat_id] = Backoff()
+                delay = backoff.next(); METRICS.inc("bot_send_retries_total")
+            print(f"[BOT][WARN] chat {chat_id}: {e}; retrying in {delay:.1f}s")
+            self._retry_until[chat_id] = time.monotonic() + delay
+            self._outbox[chat_id] = [(chunk, origins)] + self._outbox.get(chat_id, [])
+            self._first_at[chat_id] = 0.0
+        finally:
+            self._record(chat_id, status)
+            self._sending.discard(chat_id); self._send_slots.release(); self._wakeup.set()
+    def _record(self, chat_id: int, status: str):
+        log = self.deliveries.get(chat_id)
+        if log is None: log = self.deliveries[chat_id] = deque(maxlen=DELIVERY_LOG_SIZE)
+        log.append((int(time.time()), status))
     async def get_updates(self, timeout: int = 50):
         params = {"timeout": str(timeout)}
         if self.update_offset is not None: params["offset"] = str(self.update_offset)
-        try: return await self.call("getUpdates", **params)
-        except Exception as e: print(f"[BOT][WARN] getUpdates: {e}"); await asyncio.sleep(3); return []
+        return await self.call("getUpdates", **params)
+    def _accept_update(self, upd: Dict[str, Any]) -> bool:
+        uid = upd.get("update_id")
+        if uid is None: return True
+        if uid in self._seen_updates: METRICS.inc("bot_updates_total", kind="duplicate"); return False
+        METRICS.inc("bot_updates_total", kind="new")
+        self._seen_updates[uid] = None
+        if len(self._seen_updates) > 1024: self._seen_updates.popitem(last=False)
+        self.update_offset = max(self.update_offset or 0, uid + 1)
+        return True
+    async def _dispatch(self, on_update, upd: Dict[str, Any]):
+        try: await on_update(upd)
+        except Exception as e: print(f"[BOT][ERROR] update {upd.get('update_id')}: {e}")
+    async def run_polling(self, on_update):
+        # getUpdates returns 409 while a webhook is set, e.g. after switching back from BOT_MODE=webhook
+        try: await self.call("deleteWebhook")
+        except Exception as e: print(f"[BOT][WARN] deleteWebhook: {e}")
+        backoff = Backoff()
+        while True:
+            try: updates = await self.get_updates(timeout=50)
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                # bad token and the like go up to the supervisor; so does a 409, whose restart re-runs deleteWebhook
+                if not is_transient(e) or getattr(e, "status", None) == 409: raise
+                delay = getattr(e, "retry_after", None) or backoff.next()
+                print(f"[BOT][WARN] getUpdates: {e}; retrying in {delay:.1f}s")
+                await asyncio.sleep(delay); continue
+            backoff.reset()
+            for upd in updates:
+                if self._accept_update(upd): await self._dispatch(on_update, upd)
+    async def run_webhook(self, on_update, url: str, secret: str, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+        path = urlparse(url).path or "/"
+        async def receive(request: web.Request):
+            if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+                return web.Response(status=401)
+            try: upd = await request.json()
+            except ValueError: return web.Response(status=400)
+            if isinstance(upd, dict) and self._accept_update(upd):
+                # answer Telegram right away; the command runs on its own
+                task = asyncio.create_task(self._dispatch(on_update, upd))
+                self._update_tasks.add(task); task.add_done_callback(self._update_tasks.discard)
+            return web.Response(text="ok")
+        app = web.Application(); app.router.add_post(path, receive)
+        runner = web.AppRunner(app); await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        try:
+            await self.call("setWebhook", url=url, secret_token=secret,
+                            allowed_updates=json.dumps(["message", "edited_message"]))
+            print(f"[BOT] Webhook listening on {host}:{port}{path}")
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+# --- Command dispatch ---
+class CommandRegistry:
+    """Maps "/cmd" to a handler coroutine(args, chat). Each command runs in a lane:
+    "high"   – awaited inline, never queued (/stop, /status, ...)
+    "serial" – one FIFO worker, so config changes apply in the order they were sent
+    "slow"   – read-only network or disk work (/listgroups, /search, /last), own task,
+               at most COMMAND_CONCURRENCY at once
+Config commands that resolve something (/setgroup, /usegroup, /setuser) stay serial, since
+later ones apply on top of them; their lookups are capped at COMMAND_TIMEOUT."""
+    def __init__(self, max_slow: int = COMMAND_CONCURRENCY):
+        self.handlers: Dict[str, tuple] = {}
+        self.allow = None  # allow(chat_id) -> bool; commands not marked public need it
+        self._slow = asyncio.Semaphore(max(1, max_slow))
+        self._serial: "asyncio.Queue[tuple]" = asyncio.Queue()
+        self._serial_worker: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+    def command(self, name: str, lane: str = "serial", public: bool = False):
+        def deco(fn):
+            self.handlers[name] = (fn, lane, public); return fn
+        return deco
+    async def dispatch(self, upd: Dict[str, Any]):
+        msg = upd.get("message") or upd.get("edited_message")
+        if not msg: return
+        args = (msg.get("text") or "").strip().split()
+        if not args: return
+        entry = self.handlers.get(args[0].lower().split("@", 1)[0])  # "/status@MyBot" in groups
+        if not entry: return
+        fn, lane, public = entry; chat = msg.get("chat", {})
+        if not public and self.allow and not self.allow(chat.get("id")):
+            METRICS.inc("bot_commands_refused_total"); print(f"[BOT][WARN] Refused {args[0]} from chat {chat.get('id')}"); return
+        if lane == "high": await self._run(fn, args, chat)
+        elif lane == "slow": self._spawn(self._run_slow(fn, args, chat))
+        else: self._enqueue(fn, args, chat)
+    def submit(self, fn, label: str):
+        # run fn(args, chat) on the serial lane outside of any bot update
+        self._enqueue(fn, [label], {})
+    def _enqueue(self, fn, args: List[str], chat: Dict[str, Any]):
+        if self._serial_worker is None or self._serial_worker.done():
+            self._serial_worker = asyncio.create_task(self._serial_loop())
+        self._serial.put_nowait((fn, args, chat))
+    async def _run(self, fn, args: List[str], chat: Dict[str, Any]):
+        token = REPLY_TO.set(chat.get("id"))
+        try: await fn(args, chat)
+        except Exception as e: print(f"[BOT][ERROR] {args[0]}: {e}")
+        finally: REPLY_TO.reset(token)
+    async def _run_slow(self, fn, args: List[str], chat: Dict[str, Any]):
+        async with self._slow: await self._run(fn, args, chat)
+    async def _serial_loop(self):
+        while True:
+            fn, args, chat = await self._serial.get()
+            await self._run(fn, args, chat)
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task); task.add_done_callback(self._tasks.discard)
+
+# --- Subscribers ---
+class Subscribers:
+    """Chats that receive alerts (/start adds, /unsubscribe removes). A chat may override
+    the nag interval and max nags for its own alerts. Until a subscriber list exists (states
+    from before subscribers, or no list at all) the bot's primary chat is used; after that an
+    empty list means nobody, so /unsubscribe sticks across restarts.
+
+    Only allowed chats may subscribe or run commands: BOT_CHAT_ID, ALLOWED_CHAT_IDS and,
+    when neither is set, the owner, i.e. the first chat that sent /start."""
+    def __init__(self, bot: "SimpleBot"):
+        self.bot = bot
+        self.chats: Dict[int, Dict[str, Any]] = {}  # chat_id -> {"name", "interval", "max_nags"}
+        self.admins: Set[int] = set(ALLOWED_CHAT_IDS)
+        self.managed = False  # set once a subscriber list exists; from then on an empty list means nobody
+        if BOT_CHAT_ID_ENV.lstrip("-").isdigit(): self.admins.add(int(BOT_CHAT_ID_ENV))
+    def allowed(self, chat_id: Optional[int]) -> bool:
+        return chat_id is not None and chat_id in self.admins
+    def claim(self, chat_id: int) -> bool:
+        # trust on first use: with no allowlist configured, the first /start becomes the owner
+        if not self.admins:
+            self.admins.add(chat_id); self.bot.state["owner_chat_id"] = chat_id; self.bot._save_state("owner_chat_id")
+            print(f"[BOT] Chat {chat_id} is the owner. Set ALLOWED_CHAT_IDS to allow other chats.")
+        return self.allowed(chat_id)
+    def __len__(self): return len(self.chats)
+    def ids(self) -> List[int]:
+        if self.managed: return list(self.chats)
+        return [self.bot.chat_id] if self.bot.chat_id else []
+    def add(self, chat_id: int, name: str = "") -> bool:
+        new = chat_id not in self.chats; self.managed = True
+        sub = self.chats.setdefault(chat_id, {})
+        sub["name"] = name or sub.get("name", "")
+        if self.bot.chat_id is None: self.bot.chat_id = chat_id
+        return new
+    def remove(self, chat_id: int) -> bool:
+        if self.chats.pop(chat_id, None) is None: return False
+        self.managed = True
+        if self.bot.chat_id == chat_id: self.bot.chat_id = next(iter(self.chats), None)
+        return True
+    def settings(self, chat_id: int) -> Dict[str, Any]:
+        return self.chats.get(chat_id) or {}
+    def delivery_stats(self, chat_id: int) -> str:
+        log = self.bot.deliveries.get(chat_id) or ()
+        ok = sum(1 for _, st in log if st == "ok"); bad = [(t, st) for t, st in log if st != "ok"]
+        last = f", last error {bad[-1][1]} at {time.strftime('%H:%M:%S', time.localtime(bad[-1][0]))}" if bad else ""
+        return f"{ok}/{len(log)} ok{last}" if log else "no deliveries yet"
+    def to_state(self) -> Dict[str, Any]:
+        return {str(c): s for c, s in self.chats.items()}
+    def load_state(self, data: Optional[Dict[str, Any]]):
+        if not self.admins:
+            owner = self.bot.state.get("owner_chat_id") or self.bot.chat_id  # older states: the first /start
+            if owner: self.admins.add(int(owner))
+        for c, s in (data or {}).items(): self.chats[int(c)] = dict(s)
+        stray = [c for c in self.chats if not self.allowed(c)]
+        for c in stray: del self.chats[c]
+        if stray: print(f"[BOT][WARN] Dropped {len(stray)} subscriber(s) not in BOT_CHAT_ID/ALLOWED_CHAT_IDS: {stray}"); self.save()
+        if self.bot.chat_id is not None and not self.allowed(self.bot.chat_id): self.bot.chat_id = next(iter(self.chats), None)
+        if data is not None: self.managed = True
+        elif self.bot.chat_id: self.chats[self.bot.chat_id] = {"name": ""}; self.managed = True  # single-chat layout
+    def save(self):
+        self.bot.state["subscribers"] = self.to_state(); self.bot._save_state("subscribers", "bot_chat_id")
 
-# --- Alert state ---
-class AlertState:
+# --- Entity cache ---
+class EntityCache:
+    """Bounded LRU of sender id -> username ("" = user has none), persisted in state."""
+    def __init__(self, capacity: int = ENTITY_CACHE_SIZE):
+        self.capacity = max(1, capacity)
+        self._names: "OrderedDict[int, str]" = OrderedDict()
+        self._ids: Dict[str, int] = {}
+        self.hits = 0; self.misses = 0
+    def __len__(self): return len(self._names)
+    def get(self, user_id: int) -> Optional[str]:
+        name = self._names.get(user_id)
+        if name is None: self.misses += 1; return None
+        self._names.move_to_end(user_id); self.hits += 1
+        return name
+    def put(self, user_id: int, username: Optional[str]):
+        name = (username or "").lower()
+        old = self._names.pop(user_id, None)
+        if old: self._ids.pop(old, None)
+        self._names[user_id] = name
+        if name: self._ids[name] = user_id
+        while len(self._names) > self.capacity:
+            evicted_id, evicted = self._names.popitem(last=False)
+            if evicted and self._ids.get(evicted) == evicted_id: del self._ids[evicted]
+    def id_for(self, username: str) -> Optional[int]:
+        return self._ids.get(username.lstrip("@").lower())
+    def to_state(self) -> List[List[Any]]:
+        return [[u, n] for u, n in self._names.items()]
+    def load_state(self, items):
+        for u, n in items or []: self.put(int(u), n)
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = f"{100.0 * self.hits / total:.0f}%" if total else "n/a"
+        return f"{len(self)}/{self.capacity} entries, {self.hits} hits / {self.misses} misses ({rate})"
+
+# --- Routing index ---
+class WatchIndex:
+    """peer_id -> set of target sender ids, plus the titles/usernames needed for alerts.
+    Targets that could not be resolved to an id yet live in `pending` (lowercase
+    usernames) and are matched through the entity cache."""
+    def __init__(self):
+        self.routes: Dict[int, Set[int]] = {}
+        self.pending: Dict[int, Set[str]] = {}
+        self.groups: Dict[int, Dict[str, Any]] = {}
+        self.targets: Dict[int, str] = {}
+        self.current: Optional[int] = None
+        self.entities = EntityCache()
+        self.peers: Dict[int, int] = {}  # marked id -> access_hash of watched groups/targets
+        self.last_ids: Dict[int, int] = {}  # peer_id -> newest message id seen (gap recovery watermark)
+    def add_group(self, peer_id: int, title: str, link: str = "", make_current: bool = True):
+        # merged, not replaced: the entry also holds per-group interval/max_nags overrides
+        new = peer_id not in self.routes
+        self.routes.setdefault(peer_id, set())
+        g = self.groups.setdefault(peer_id, {})
+        g["title"] = title or g.get("title", ""); g["link"] = link or g.get("link", "")
+        if new or make_current or self.current is None: self.current = peer_id
+    def remove_group(self, peer_id: int) -> bool:
+        if self.routes.pop(peer_id, None) is None: return False
+        self.groups.pop(peer_id, None); self.pending.pop(peer_id, None); self.peers.pop(peer_id, None)
+        self.last_ids.pop(peer_id, None)
+        if self.current == peer_id: self.current = next(iter(self.routes), None)
+        self._prune_targets(); return True
+    def add_target(self, peer_id: int, user_id: int, username: Optional[str]):
+        self.routes.setdefault(peer_id, set()).add(user_id)
+        self.targets[user_id] = username or self.targets.get(user_id, "")
+        if username:
+            self.entities.put(user_id, username)
+            names = self.pending.get(peer_id)
+            if names: names.discard(username.lower())
+    def add_pending(self, peer_id: int, username: str):
+        self.routes.setdefault(peer_id, set())
+        self.pending.setdefault(peer_id, set()).add(username.lstrip("@").lower())
+    def remove_pending(self, username: str, peer_id: Optional[int] = None) -> bool:
+        name = username.lstrip("@").lower(); found = False
+        for p in ([peer_id] if peer_id is not None else list(self.pending)):
+            names = self.pending.get(p)
+            if names and name in names:
+                names.discard(name); found = True
+                if not names: del self.pending[p]
+        return found
+    def match_username(self, peer_id: int, user_id: int, username: Optional[str]) -> bool:
+        # promote a pending username target to an id target once we have seen it
+        names = self.pending.get(peer_id)
+        if not names or not username or username.lower() not in names: return False
+        self.add_target(peer_id, user_id, username)
+        if not names: del self.pending[peer_id]
+        return True
+    def remove_target(self, user_id: int, peer_id: Optional[int] = None) -> bool:
+        peers = [peer_id] if peer_id is not None else list(self.routes)
+        found = False
+        for p in peers:
+            ids = self.routes.get(p)
+            if ids and user_id in ids: ids.discard(user_id); found = True
+        self._prune_targets(); return found
+    def clear(self):
+        self.routes.clear(); self.pending.clear(); self.groups.clear(); self.targets.clear(); self.current = None
+        self.last_ids.clear()
+    def _prune_targets(self):
+        live = set().union(*self.routes.values()) if self.routes else set()
+        for uid in [u for u in self.targets if u not in live]:
+            del self.targets[uid]; self.peers.pop(uid, None)
+    def remember_peer(self, entity):
+        try: p = get_input_peer(entity, allow_self=False)
+        except TypeError: return
+        if isinstance(p, (InputPeerUser, InputPeerChannel)): self.peers[get_peer_id(p)] = p.access_hash
+        elif isinstance(p, InputPeerChat): self.peers[get_peer_id(p)] = 0
+    def input_peers(self) -> list:
+        out = []
+        for marked, access_hash in self.peers.items():
+            real, kind = resolve_id(marked)
+            if kind is PeerChannel: out.append(InputPeerChannel(real, access_hash))
+            elif kind is PeerChat: out.append(InputPeerChat(real))
+            else: out.append(InputPeerUser(real, access_hash))
+        return out
+    def title(self, peer_id: Optional[int]) -> str:
+        g = self.groups.get(peer_id) if peer_id is not None else None
+        return (g or {}).get("title") or str(peer_id or "(unset group)")
+    def who(self, user_id: int) -> str:
+        uname = self.targets.get(user_id)
+        return f"@{uname}" if uname else f"id={user_id}"
+    def pair_count(self) -> int:
+        return sum(len(ids) for ids in self.routes.values()) + sum(len(n) for n in self.pending.values())
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            "routes": {str(p): sorted(ids) for p, ids in self.routes.items()},
+            "groups": {str(p): g for p, g in self.groups.items()},
+            "targets": {str(u): n for u, n in self.targets.items()},
+            "pending": {str(p): sorted(n) for p, n in self.pending.items() if n},
+            "current_group": self.current,
+            "entity_cache": self.entities.to_state(),
+            "input_peers": {str(p): h for p, h in self.peers.items()},
+            "last_ids": {str(p): i for p, i in self.last_ids.items()},
+        }
+    def load_state(self, state: Dict[str, Any]):
+        self.clear()
+        for p, g in (state.get("groups") or {}).items(): self.groups[int(p)] = dict(g)
+        for p, ids in (state.get("routes") or {}).items(): self.routes[int(p)] = {int(i) for i in ids}
+        for u, n in (state.get("targets") or {}).items(): self.targets[int(u)] = n or ""
+        for p, names in (state.get("pending") or {}).items():
+            for n in names: self.add_pending(int(p), n)
+        self.entities.load_state(state.get("entity_cache"))
+        for p, h in (state.get("input_peers") or {}).items():
+            if int(p) in self.groups or int(p) in self.targets: self.peers[int(p)] = int(h)  # drops stray senders
+        for p, i in (state.get("last_ids") or {}).items():
+            if int(p) in self.groups: self.last_ids[int(p)] = int(i)
+        for u, n in self.targets.items():
+            if n: self.entities.put(u, n)
+        for p in self.groups: self.routes.setdefault(p, set())
+        cur = state.get("current_group")
+        self.current = int(cur) if cur is not None and int(cur) in self.routes else next(iter(self.routes), None)
+        # migrate the single group/user layout
+        legacy_peer = state.get("group_peer_id")
+        if legacy_peer and int(legacy_peer) not in self.routes:
+            self.add_group(int(legacy_peer), state.get("group_title") or "", state.get("group_link") or "")
+            if state.get("target_id"):
+                self.add_target(int(legacy_peer), int(state["target_id"]), state.get("target_username"))
+
+class RoutedMessageEdited(events.MessageEdited):
+    """MessageEdited counterpart of RoutedNewMessage (edits feed the burst digests)."""
+    def __init__(self, index: "WatchIndex", chats=None, **kwargs):
+        self.routes = index.routes if chats is None else chats
+        super().__init__(chats=self.routes, **kwargs)
+        self.index = index
+    async def _resolve(self, client):
+        self.chats = self.routes
+        self.from_users = None
+
+class RoutedNewMessage(events.NewMessage):
+    """NewMessage builder whose chat whitelist is the live routing index (or a shard's
+    part of it), so Telethon drops unrelated chats before the handler is scheduled."""
+    def __init__(self, index: WatchIndex, chats=None, **kwargs):
+        self.routes = index.routes if chats is None else chats
+        super().__init__(chats=self.routes, **kwargs)
+        self.index = index
+    async def _resolve(self, client):
+        self.chats = self.routes  # dict keys / set: O(1) membership, always current
+        self.from_users = None
+
+# --- Dialog index ---
+class DialogIndex:
+    """The account's groups, listed once at startup and then kept current from chat
+    actions (join/leave/kick/rename), so /listgroups pages and filters in memory and
+    /usegroup takes the cached entity instead of looking it up again."""
+    PAGE_SIZE = 40
     def __init__(self):
-        self.nag_active=False; self.nag_started_at=0.0; self.last_nag_sent_at=0.0; self.nag_count=0; self.reason=""
-    def start(self, reason:str):
-        self.nag_active=True; self.nag_started_at=time.time(); self.last_nag_sent_at=0.0; self.nag_count=0; self.reason=reason
-    def stop(self): self.nag_active=False
+        self.chats: Dict[int, Any] = {}  # peer_id -> Chat/Channel entity
+        self.ready = False
+        self.me_id: Optional[int] = None
+        self._sorted: Optional[List[tuple]] = None  # (title.casefold(), peer_id), rebuilt on change
+        self._loading: Optional[asyncio.Task] = None
+    def __len__(self): return len(self.chats)
+    def add(self, entity):
+        if not isinstance(entity, (Chat, Channel)) or getattr(entity, "left", False): return
+        self.chats[get_peer_id(entity)] = entity; self._sorted = None
+    def remove(self, peer_id: int):
+        if self.chats.pop(peer_id, None) is not None: self._sorted = None
+    def title(self, peer_id: int) -> str:
+        return getattr(self.chats.get(peer_id), "title", None) or str(peer_id)
+    async def build(self, client: TelegramClient):
+        t0 = time.perf_counter()
+        if self.me_id is None: self.me_id = (await client.get_me(input_peer=True)).user_id
+        fresh: Dict[int, Any] = {}
+        async for d in client.iter_dialogs(limit=None, ignore_migrated=True):
+            if isinstance(d.entity, (Chat, Channel)): fresh[d.id] = d.entity
+        self.chats = fresh; self._sorted = None; self.ready = True
+        print(f"[DIALOGS] Indexed {len(fresh)} group(s) in {time.perf_counter() - t0:.2f}s")
+    def refresh(self, client: TelegramClient) -> asyncio.Task:
+        # one listing at a time; callers can await the returned task
+        if self._loading is None or self._loading.done():
+            self._loading = asyncio.create_task(self.build(client))
+        return self._loading
+    async def on_chat_action(self, event):
+        if event.new_title and event.chat_id in self.chats:
+            ent = self.chats[event.chat_id]
+            try: ent.title = event.new_title; self._sorted = None
+            except AttributeError: pass
+        if not (event.created or event.user_joined or event.user_added or event.user_left or event.user_kicked): return
+        if not event.created and self.me_id not in (event.user_ids or []): return
+        if event.user_left or event.user_kicked: self.remove(event.chat_id); return
+        try: self.add(await event.get_chat())
+        except Exception as e: print(f"[DIALOGS][WARN] {e}")
+    def page(self, page: int = 1, needle: str = "") -> tuple:
+        # -> (rows [(peer_id, title)], page, pages, total matching)
+        if self._sorted is None:
+            self._sorted = sorted(((getattr(e, "title", "") or "").casefold(), p) for p, e in self.chats.items())
+        needle = needle.casefold().strip()
+        rows = [p for t, p in self._sorted if needle in t or needle == str(p)] if needle else [p for _, p in self._sorted]
+        pages = max(1, -(-len(rows) // self.PAGE_SIZE)); page = min(max(1, page), pages)
+        chunk = rows[(page - 1) * self.PAGE_SIZE: page * self.PAGE_SIZE]
+        return [(p, self.title(p)) for p in chunk], page, pages, len(rows)
+
+LEGACY_STATE_KEYS = ("group_link", "group_title", "group_peer_id", "target_id", "target_username")
+
+def save_index(bot: "SimpleBot", index: WatchIndex):
+    for k in LEGACY_STATE_KEYS: bot.state.pop(k, None)
+    data = index.to_state()
+    bot.state.update(data); bot._save_state(*data, *LEGACY_STATE_KEYS)
+
+def save_watermarks(bot: "SimpleBot", index: WatchIndex):
+    bot.state["last_ids"] = {str(p): i for p, i in index.last_ids.items()}; bot._save_state("last_ids")
+
+# --- Alert scheduler ---
+class Alert:
+    __slots__ = ("key", "reason", "who", "where", "interval", "max_nags", "count", "started_at", "due", "version")
+    def __init__(self, key):
+        self.key = key; self.version = -1; self.count = 0
+
+class AlertScheduler:
+    """Many concurrent nag alerts on one timer heap. Entries are (due, seq, version, key);
+    restarting or stopping an alert bumps/drops its version so old heap entries are
+    skipped lazily, which keeps both operations O(log n). The run loop sleeps until the
+    earliest due time and blocks on an Event when nothing is scheduled."""
+    def __init__(self):
+        self.alerts: Dict[Any, Alert] = {}
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+    def __len__(self): return len(self.alerts)
+    def start(self, key, reason: str, who: str, where: str, interval: float, max_nags: int = 0) -> Alert:
+        a = self.alerts.get(key) or Alert(key)
+        a.reason = reason; a.who = who; a.where = where; a.interval = max(1.0, float(interval)); a.max_nags = max_nags
+        a.count = 0; a.started_at = time.time(); a.due = time.monotonic(); a.version = next(self._seq)
+        self.alerts[key] = a; self._push(a)
+        return a
+    def stop(self, key=None) -> int:
+        if key is None:
+            n = len(self.alerts); self.alerts.clear(); self._heap.clear(); return n
+        return 1 if self.alerts.pop(key, None) else 0
+    def stop_where(self, pred) -> int:
+        keys = [k for k in self.alerts if pred(k)]
+        for k in keys: del self.alerts[k]
+        return len(keys)
+    def _push(self, a: Alert):
+        heapq.heappush(self._heap, (a.due, next(self._seq), a.version, a.key))
+        if self._heap[0][3] == a.key: self._wakeup.set()  # new earliest deadline
+        if len(self._heap) > 2 * len(self.alerts) + 64:  # drop stale entries now and then
+            self._heap = [e for e in self._heap if not self._stale(e)]; heapq.heapify(self._heap)
+    def _stale(self, entry) -> bool:
+        a = self.alerts.get(entry[3])
+        return a is None or a.version != entry[2]
+    async def run(self, on_nag, on_done):
+        while True:
+            while self._heap and self._stale(self._heap[0]): heapq.heappop(self._heap)
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait(); continue
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                try: await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError: pass
+                continue
+            a = self.alerts[heapq.heappop(self._heap)[3]]
+            METRICS.observe("nag_lateness_seconds", time.monotonic() - a.due)
+            try: sent = on_nag(a) is not False
+            except Exception as e: print(f"[ALERT][ERROR] {a.key}: {e}"); sent = False  # keep it scheduled
+            if sent: a.count += 1; METRICS.inc("nags_sent_total")
+            if a.max_nags and a.count >= a.max_nags:
+                del self.alerts[a.key]; on_done(a)
+            else:
+                a.due += a.interval
+                if a.due < time.monotonic(): a.due = time.monotonic() + a.interval  # don't burst after a stall
+                self._push(a)
+
+# --- Rules ---
+# A rule spec (per "*", "<peer_id>" or "<peer_id>:<user_id>", most specific wins):
+#   any:   substrings, words: whole words, regex: patterns   -> at least one must match (if any set)
+#   none:  substrings that reject the message
+#   media: allowed kinds (text, photo, video, audio, document, other)
+#   hours: "HH[:MM]-HH[:MM]" window in RULES_TZ, may wrap midnight
+RULE_LIST_FIELDS = ("any", "words", "regex", "none", "media")
+MEDIA_KINDS = ("text", "photo", "video", "audio", "document", "other")
+
+def trie_regex(words) -> str:
+    # Keywords folded into one prefix-tree pattern: re's C engine then walks it like a
+    # single automaton, so cost grows with message length, not with the keyword count.
+    trie: Dict[str, Any] = {}
+    for w in words:
+        node = trie
+        for ch in w: node = node.setdefault(ch, {})
+        node[""] = {}
+    def build(node) -> str:
+        kids = sorted(k for k in node if k)
+        if not kids: return ""
+        if len(kids) > 1 and all(list(node[k]) == [""] for k in kids):
+            body = "[" + "".join(re.escape(k) for k in kids) + "]"
+        else:
+            alts = [re.escape(k) + build(node[k]) for k in kids]
+            body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+    return build(trie)
+
+def parse_hours(spec: str):
+    def minute(hhmm: str) -> int:
+        h, _, m = hhmm.strip().partition(":")
+        h, m = int(h), int(m or 0)
+        if not (0 <= h <= 24 and 0 <= m < 60): raise ValueError(f"bad time {hhmm!r}")
+        return h * 60 + m
+    start, sep, end = spec.partition("-")
+    if not sep: raise ValueError("hours must look like 08:00-20:00")
+    return minute(start), minute(end)
+
+def media_kind(message) -> str:
+    media = getattr(message, "media", None)
+    if media is None: return "text"
+    if isinstance(media, MessageMediaPhoto): return "photo"
+    if isinstance(media, MessageMediaDocument):
+        mime = getattr(getattr(media, "document", None), "mime_type", "") or ""
+        return "video" if mime.startswith("video/") else "audio" if mime.startswith("audio/") else "document"
+    return "other"
+
+class CompiledRule:
+    SCAN_MAX = 128  # up to this many plain keywords, str.__contains__ beats the regex
+    __slots__ = ("scan", "keywords", "regexes", "negative", "media", "window", "tz")
+    def __init__(self, spec: Dict[str, Any]):
+        words = [w.lower() for w in spec.get("any") or [] if w]
+        whole = [w.lower() for w in spec.get("words") or [] if w]
+        parts = []
+        self.scan = tuple(words) if words and not whole and len(words) <= self.SCAN_MAX else None
+        if words and self.scan is None: parts.append(trie_regex(words))
+        if whole: parts.append(r"\b(?:" + trie_regex(whole) + r")\b")
+        # keywords run on a lowercased copy: IGNORECASE would cost re its literal-prefix fast scan
+        self.keywords = re.compile("|".join(parts)) if parts else None
+        self.regexes = [re.compile(r) for r in spec.get("regex") or []]  # validated one by one
+        # only group-free patterns are joined: joining renumbers groups and breaks backreferences
+        plain = [r for r in self.regexes if not r.groups]
+        if len(plain) > 1:
+            try: self.regexes = [re.compile("|".join(f"(?:{r.pattern})" for r in plain))] + [r for r in self.regexes if r.groups]
+            except re.error: pass  # e.g. inline flags that can't be combined
+        negative = [w.lower() for w in spec.get("none") or [] if w]
+        self.negative = re.compile(trie_regex(negative)) if negative else None
+        media = spec.get("media")
+        self.media = frozenset(media) if media else None
+        self.window = parse_hours(spec["hours"]) if spec.get("hours") else None
+        self.tz = ZoneInfo(RULES_TZ) if RULES_TZ and self.window else None
+    def check(self, event) -> Optional[str]:
+        # None = passes; otherwise the name of the failing stage. Cheapest checks first.
+        if self.media is not None and media_kind(event.message) not in self.media: return "media"
+        if self.window is not None:
+            d = datetime.fromtimestamp(event.date.timestamp() if event.date else time.time(), self.tz)
+            m = d.hour * 60 + d.minute; start, end = self.window
+            if not (start <= m < end if start <= end else m >= start or m < end): return "hours"
+        text = event.raw_text or ""
+        body = text if self.negative is None and self.keywords is None and self.scan is None else text.lower()
+        if self.negative is not None and self.negative.search(body): return "negative"
+        if self.scan is None and self.keywords is None and not self.regexes: return None
+        if self.scan is not None and any(k in body for k in self.scan): return None
+        if self.keywords is not None and self.keywords.search(body): return None
+        if any(r.search(text) for r in self.regexes): return None
+        return "keyword"
+
+class RuleBook:
+    """Rule specs by scope, each compiled once when it changes; resolve() is a few dict lookups."""
+    def __init__(self, default_keywords: Optional[List[str]] = None):
+        self.specs: Dict[str, Dict[str, Any]] = {}
+        self._compiled: Dict[tuple, CompiledRule] = {}
+        kws = REQUIRED_KEYWORDS if default_keywords is None else default_keywords
+        self._default = CompiledRule({"any": kws}) if kws else None
+    @staticmethod
+    def scope_key(scope: str) -> tuple:
+        if scope == "*": return (None, None)
+        peer, _, user = scope.partition(":")
+        return (int(peer), int(user) if user else None)
+    def set(self, scope: str, spec: Dict[str, Any]):
+        spec = {k: v for k, v in spec.items() if v}
+        key = self.scope_key(scope)
+        if not spec: self.specs.pop(scope, None); self._compiled.pop(key, None); return
+        compiled = CompiledRule(spec)  # raises on a bad regex/hours before anything changes
+        self.specs[scope] = spec; self._compiled[key] = compiled
+    def resolve(self, peer_id: int, user_id: int) -> Optional[CompiledRule]:
+        c = self._compiled
+        if not c: return self._default
+        return c.get((peer_id, user_id)) or c.get((peer_id, None)) or c.get((None, None)) or self._default
+    def to_state(self) -> Dict[str, Any]:
+        return dict(self.specs)
+    def load_state(self, data: Optional[Dict[str, Any]]):
+        for scope, spec in (data or {}).items():
+            try: self.set(scope, spec)
+            except Exception as e: print(f"[WARN] Dropping rule {scope}: {e}")
+
+# --- Media relay ---
+class MediaTooLarge(Exception): pass
+
+class MediaRelay:
+    """Relays photos, videos and documents to the bot chat. Each file is piped from
+    Telethon's chunked download straight into a multipart upload, so a transfer holds a
+    few chunks at most. Transfers run beside the outbox, MEDIA_CONCURRENCY at a time."""
+    def __init__(self, bot: "SimpleBot", max_bytes: int = MEDIA_MAX_BYTES, concurrency: int = MEDIA_CONCURRENCY):
+        self.bot = bot
+        self.max_bytes = max_bytes
+        self._sem = asyncio.Semaphore(max(1, concurrency))
+        self._tasks: Set[asyncio.Task] = set()
+        self.active = 0
+    def relay(self, client, message, caption: str, chat_ids: Optional[List[int]] = None) -> Optional[str]:
+        # schedules the upload and returns a note for the text alert (None when there is no media)
+        kind = media_kind(message)
+        if kind == "text": return None
+        if kind == "other" or client is None: return "📎 (media present but not forwarded)"
+        f = message.file
+        size = getattr(f, "size", None) or 0
+        if size > self.max_bytes:
+            METRICS.inc("media_relayed_total", kind=kind, result="too_large")
+            return f"📎 {kind} ({size / 2**20:.1f} MB) is over the {self.max_bytes / 2**20:g} MB relay limit, not forwarded"
+        chat_ids = chat_ids or [self.bot.chat_id]
+        task = asyncio.create_task(self._send(client, message, kind, size, caption, chat_ids))
+        self._tasks.add(task); task.add_done_callback(self._tasks.discard)
+        return f"📎 {kind} follows"
+    async def _chunks(self, client, message):
+        n = 0
+        async for chunk in client.iter_download(message.media, chunk_size=MEDIA_CHUNK_BYTES):
+            n += len(chunk)
+            if n > self.max_bytes: raise MediaTooLarge(f"over {self.max_bytes / 2**20:g} MB")
+            METRICS.inc("media_bytes_total", len(chunk))
+            yield chunk
+    async def _send(self, client, message, kind: str, size: int, caption: str, chat_ids: List[int]):
+        async with self._sem:
+            self.active += 1; t0 = time.perf_counter()
+            f = message.file
+            mime = getattr(f, "mime_type", None) or "application/octet-stream"
+            name = getattr(f, "name", None) or f"{kind}{getattr(f, 'ext', None) or ''}"
+            if kind == "photo" and size <= BOT_PHOTO_LIMIT: method, field = "sendPhoto", "photo"
+            elif kind == "video": method, field = "sendVideo", "video"
+            else: method, field = "sendDocument", "document"
+            try:
+                # streamed once to the first subscriber; the others get a server-side copy
+                sent = await self.bot.send_file(method, field, lambda: self._chunks(client, message), name, mime, caption, chat_ids[0])
+                METRICS.inc("media_relayed_total", kind=kind, result="ok")
+                if sent and len(chat_ids) > 1:
+                    await asyncio.gather(*(self._copy(c, chat_ids[0], sent["message_id"]) for c in chat_ids[1:]))
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                report_flood(client, e)
+                METRICS.inc("media_relayed_total", kind=kind, result="error")
+                print(f"[MEDIA][ERROR] {kind} {name}: {e}")
+                for c in chat_ids: self.bot.send_message(f"📎 Could not relay {kind} ({name}): {e}", chat_id=c)
+            finally:
+                self.active -= 1
+                METRICS.observe("media_relay_seconds", time.perf_counter() - t0)
+    async def _copy(self, chat_id: int, from_chat_id: int, message_id: int):
+        try:
+            await self.bot.call("copyMessage", chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
+            self.bot._record(chat_id, "ok")
+        except Exception as e:
+            self.bot._record(chat_id, str(getattr(e, "status", "network")))
+            print(f"[MEDIA][WARN] copy to {chat_id} failed: {e}")
+    async def close(self):
+        for t in list(self._tasks): t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+# --- Burst coalescing ---
+class Burst:
+    __slots__ = ("triggered", "items", "timer")
+    def __init__(self):
+        self.triggered = False
+        self.items: "OrderedDict[int, tuple]" = OrderedDict()  # msg_id -> (when, text, link, edited)
+        self.timer = None
+
+class BurstCoalescer:
+    """One trigger per burst. The first message from a (group, target) is forwarded at once;
+    messages arriving within `window` seconds after it are held and sent as one digest when
+    the window closes, and the window slides while the target keeps posting. Edits are
+    keyed by message id, so several edits of one message collapse into a single entry."""
+    def __init__(self, on_digest, window: float = ALERT_COALESCE_SECONDS, max_items: int = DIGEST_MAX_ITEMS):
+        self.on_digest = on_digest  # on_digest(key, entries, dropped)
+        self.window = window; self.max_items = max_items
+        self.bursts: Dict[tuple, Burst] = {}
+        self.dropped: Dict[tuple, int] = {}
+    def __len__(self): return len(self.bursts)
+    def running(self, key: tuple) -> bool:
+        # True when offer(key, ...) would put the message into a digest
+        b = self.bursts.get(key)
+        return self.window > 0 and b is not None and b.triggered
+    def offer(self, key: tuple, msg_id: int, entry: tuple) -> bool:
+        # True when a burst is already running and the message went into its digest
+        if self.window <= 0: return False
+        b = self.bursts.get(key)
+        if b is None: b = self._open(key)
+        if not b.triggered: b.triggered = True; return False
+        self._add(key, b, msg_id, entry); return True
+    def edit(self, key: tuple, msg_id: int, entry: tuple):
+        if self.window <= 0: return
+        b = self.bursts.get(key) or self._open(key)
+        self._add(key, b, msg_id, entry)
+    def _open(self, key: tuple) -> Burst:
+        b = self.bursts[key] = Burst()
+        b.timer = asyncio.get_running_loop().call_later(self.window, self._close, key)
+        return b
+    def _add(self, key: tuple, b: Burst, msg_id: int, entry: tuple):
+        if msg_id in b.items:
+            # an edit of a message that is still waiting: keep its slot and media note, take the new text
+            when, _, link, edited, note = b.items[msg_id]
+            b.items[msg_id] = (when, entry[1], link, edited and entry[3], note)
+        elif len(b.items) < self.max_items: b.items[msg_id] = entry
+        else: self.dropped[key] = self.dropped.get(key, 0) + 1
+    def _close(self, key: tuple):
+        b = self.bursts.get(key)
+        if b is None: return
+        if not b.items: del self.bursts[key]; return
+        entries = list(b.items.values()); b.items.clear()
+        self.on_digest(key, entries, self.dropped.pop(key, 0))
+        b.timer = asyncio.get_running_loop().call_later(self.window, self._close, key)  # still bursting?
+    def close(self):
+        # shutdown: send whatever is waiting and drop the timers
+        for key, b in list(self.bursts.items()):
+            if b.timer: b.timer.cancel()
+            if b.items: self.on_digest(key, list(b.items.values()), self.dropped.pop(key, 0))
+        self.bursts.clear()
+
+# --- Triggers ---
+def nag_settings(index: WatchIndex, peer_id: Optional[int], sub: Optional[Dict[str, Any]] = None):
+    # subscriber override > group setting > global
+    g = index.groups.get(peer_id, {}) if peer_id is not None else {}
+    interval, max_nags = g.get("interval") or NAG_INTERVAL_SECONDS, g.get("max_nags", MAX_NAGS)
+    if sub: interval, max_nags = sub.get("interval") or interval, sub.get("max_nags", max_nags)
+    return interval, max_nags
+
+def make_nag_callbacks(bot: "SimpleBot"):
+    # alert keys start with the subscriber's chat id
+    def send_nag(a: Alert):
+        if not a.key[0]: return False
+        bot.send_message(NAG_MESSAGE_TEMPLATE.format(who=a.who or "(unset user)", where=a.where or "(unset group)"), chat_id=a.key[0])
+    def nags_done(a: Alert):
+        bot.send_message(f"⛔ Max nags reached for {a.who} in {a.where}.", chat_id=a.key[0])
+    return send_nag, nags_done
+
+def build_trigger_handler(bot: "SimpleBot", index: WatchIndex, alerts: AlertScheduler, rules: Optional[RuleBook] = None,
+                          media: Optional[MediaRelay] = None, subs: Optional[Subscribers] = None,
+                          coalesce_window: float = ALERT_COALESCE_SECONDS, archive: Optional[Archive] = None):
+    """The NewMessage handler. Needs only the objects it routes through, so
+    loadtest.py can drive it with synthetic events and no Telegram connection."""
+    rules = rules or RuleBook()
+    subs = subs or Subscribers(bot)
+    alerted: "OrderedDict[tuple, None]" = OrderedDict()  # live events and backfill can overlap
+
+    def send_digest(key: tuple, entries: List[tuple], dropped: int):
+        peer_id, target_id = key
+        header = f"🧾 Digest: {len(entries)} more update(s) from {index.who(target_id)} in {index.title(peer_id)}"
+        lines = []
+        for when, text, link, edited, note in entries:
+            lines.append(f"\n{'✏️ edited ' if edited else ''}🕒 {when}\n{text}{note}" + (f"\n🔗 {link}" if link else ""))
+        if dropped: lines.append(f"\n… and {dropped} more not shown")
+        parts = split_message(header, lines)
+        for chat_id in subs.ids():
+            for part in parts: bot.send_message(part, chat_id=chat_id)
+        METRICS.inc("digests_sent_total")
+    bursts = BurstCoalescer(send_digest, coalesce_window)
+
+    async def on_new_message(event):
+        t0 = time.perf_counter()
+        peer_id = event.chat_id
+        targets = index.routes.get(peer_id)
+        if targets is None: METRICS.inc("events_total", stage="no_route"); return
+        msg_id = event.id
+        if msg_id and msg_id > index.last_ids.get(peer_id, 0): index.last_ids[peer_id] = msg_id
+        if archive is not None and archive.archive_all:
+            archive.add(peer_id, msg_id, event.sender_id, event.date, event.raw_text or "", False)
+
+        # fast path: the sender id is in the update, no entity lookup needed
+        sender_id = event.sender_id
+        if sender_id is None: METRICS.inc("events_total", stage="no_sender"); return
+        if sender_id in targets: target_id = sender_id
+        elif peer_id in index.pending:
+            # only username-only targets need the sender's username
+            uname = index.entities.get(sender_id); sender = None
+            if uname is None:
+                sender = event.sender  # present when the update carried the entity
+                if sender is None:
+                    try: sender = await event.get_sender()
+                    except Exception as e: sender = None; report_flood(getattr(event, "client", None), e)
+                if sender is None: METRICS.inc("events_total", stage="no_sender"); return
+                uname = getattr(sender, "username", None) or ""
+                index.entities.put(sender_id, uname)  # bounded LRU; input peers are kept for targets only
+            if not index.match_username(peer_id, sender_id, uname): METRICS.inc("events_total", stage="not_target"); return
+            if sender is not None: index.remember_peer(sender)
+            target_id = sender_id; save_index(bot, index)
+        else: METRICS.inc("events_total", stage="not_target"); return
+
+        if isinstance(event, events.MessageEdited.Event):
+            # only edits of messages we already forwarded matter; they go to the burst digest
+            if (peer_id, msg_id) not in alerted: METRICS.inc("events_total", stage="edit_ignored"); return
+            if archive is not None: archive.add(peer_id, msg_id, sender_id, event.date, event.raw_text or "", True)
+            when = event.date.strftime("%H:%M:%S") if event.date else "now"
+            bursts.edit((peer_id, target_id), msg_id, (when, safe_slice(event.raw_text or "(no text)", 3600),
+                                                       build_message_link(peer_id, msg_id), True, ""))
+            METRICS.inc("events_total", stage="edit"); return
+
+        # optional per group/target rules (REQUIRED_KEYWORDS is the default)
+        rule = rules.resolve(peer_id, target_id)
+        if rule is not None:
+            failed = rule.check(event)
+            if failed: METRICS.inc("events_total", stage=failed); return
+        key = (peer_id, msg_id)
+        if key in alerted: METRICS.inc("events_total", stage="duplicate"); return
+        alerted[key] = None
+        if len(alerted) > 4096: alerted.popitem(last=False)
+        save_watermarks(bot, index)  # `alerted` is memory only: a replay after a crash must start past this message
+        if archive is not None: archive.add(peer_id, msg_id, sender_id, event.date, event.raw_text or "", True)
+        who = index.who(target_id); where = index.title(peer_id)
+        recipients = subs.ids()
+        def media_note() -> str:
+            # starts the file relay (if any) and returns the line that goes with the text
+            if event.message is None or event.message.media is None: return ""
+            if media is None or not recipients: return "\n📎 (media present but not forwarded)"
+            note = media.relay(getattr(event, "client", None), event.message, f"📎 From {who} in {where}", recipients)
+            return f"\n{note}" if note else ""
+        if bursts.running((peer_id, target_id)):
+            # held for the digest, but its file goes out now like any other
+            bursts.offer((peer_id, target_id), msg_id, (
+                event.date.strftime("%H:%M:%S") if event.date else "now", safe_slice(event.raw_text or "(no text)", 3600),
+                build_message_link(peer_id, msg_id), False, media_note()))
+            METRICS.inc("events_total", stage="coalesced"); return
+        bursts.offer((peer_id, target_id), msg_id, None)  # opens the burst; this message is the trigger
+        METRICS.inc("events_total", stage="triggered")
+
+        when = event.date.strftime("%Y-%m-%d %H:%M:%S") if event.date else "now"
+        origin = event.date.timestamp() if event.date else None
+        if not recipients: print("[BOT] No subscribers yet. DM /start to register."); return
+        for chat_id in recipients:
+            interval, max_nags = nag_settings(index, peer_id, subs.settings(chat_id))
+            alerts.start((chat_id, peer_id, target_id), f"Message from {who} in {where} at {when}", who, where, interval, max_nags)
+
+        text = event.raw_text or "(no text)"
+        link = build_message_link(peer_id, getattr(event, 'id', None))
+        header = f"📨 Forwarded message\nFrom {who} in {where}\n🕒 {when}"
+        body = safe_slice(text, 3600)
+        tail = f"\n🔗 Open: {link}" if link else ""
+        forward = f"{header}\n\n{body}{media_note()}{tail}"
+        trigger = f"🚨 Trigger: {who} posted in {where} at {when}. I'll keep pinging you until you /stop."
+        # fan-out: one outbox entry per subscriber; the outbox sends to different chats concurrently
+        for chat_id in recipients:
+            bot.send_message(forward, chat_id=chat_id, origin=origin); bot.send_message(trigger, chat_id=chat_id)
+        METRICS.observe("handler_seconds", time.perf_counter() - t0)
+    on_new_message.bursts = bursts
+    return on_new_message
+
+# --- Gap recovery ---
+class GapRecovery:
+    """Replays messages posted while the watcher was offline or disconnected through the
+    normal handler. The watermark (newest id seen per group) is snapshotted when the gap
+    opens, and the gap is fetched oldest-first in a background task, so live events keep
+    flowing; the handler's dedupe drops anything seen both ways."""
+    def __init__(self, client_for, index: WatchIndex, bot: "SimpleBot", handler, limit: int = BACKFILL_LIMIT):
+        # client_for(peer_id) -> the TelegramClient that currently watches that group
+        self.client_for = client_for; self.index = index; self.bot = bot; self.handler = handler; self.limit = limit
+        self._since: Dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._again = False
+        self._saved: Dict[int, int] = dict(index.last_ids)
+    def mark_gap(self, peers=None):
+        # keep the oldest watermark if an earlier gap has not been filled yet
+        for p in list(self.index.last_ids if peers is None else peers):
+            i = self.index.last_ids.get(p)
+            if i: self._since[p] = min(i, self._since.get(p, i))
+    def request(self):
+        if not self.limit or not self._since: return
+        if self._task and not self._task.done(): self._again = True; return
+        self._task = asyncio.create_task(self._backfill())
+    async def _backfill(self):
+        while True:
+            since, self._since = self._since, {}
+            self._again = False
+            for peer_id, min_id in since.items():
+                if peer_id not in self.index.routes: continue
+                n = 0; t0 = time.perf_counter(); client = self.client_for(peer_id)
+                try:
+                    async for msg in client.iter_messages(peer_id, min_id=min_id, reverse=True, limit=self.limit):
+                        ev = events.NewMessage.Event(msg); ev._client = client
+                        await self.handler(ev); n += 1
+                        if n % 100 == 0: await asyncio.sleep(0)  # one fetched batch; let live events in
+                except asyncio.CancelledError: raise
+                except Exception as e:
+                    report_flood(client, e)
+                    print(f"[BACKFILL][WARN] {self.index.title(peer_id)}: {e}")
+                    self._since.setdefault(peer_id, min_id); continue
+                METRICS.inc("backfill_messages_total", n)
+                if n: print(f"[BACKFILL] {n} missed message(s) in {self.index.title(peer_id)} in {time.perf_counter() - t0:.2f}s")
+                if n >= self.limit: print(f"[BACKFILL][WARN] Stopped at BACKFILL_LIMIT={self.limit} for {self.index.title(peer_id)}")
+            if not self._again: return
+    def checkpoint(self):
+        if self.index.last_ids == self._saved: return
+        self._saved = dict(self.index.last_ids); save_watermarks(self.bot, self.index)
+    async def run(self, checkpoint_every: float = 30.0):
+        # startup catch-up, then periodic watermark checkpoints (ShardPool reports reconnects)
+        self.request()
+        while True:
+            await asyncio.sleep(checkpoint_every)
+            self.checkpoint()
+
+# --- Account shards ---
+def report_flood(client, err: Exception):
+    # a FloodWait on any call made through a shard's client puts that shard in cooldown
+    hook = getattr(client, "on_flood", None)
+    if hook and isinstance(err, FloodWaitError): hook(err.seconds)
+
+class Shard:
+    __slots__ = ("n", "client", "name", "peers", "connected", "cooldown_until", "readable", "dialogs_loaded", "retry_at")
+    def __init__(self, n: int, client: TelegramClient):
+        self.n = n; self.client = client; self.name = f"#{n}"
+        self.peers: Set[int] = set()  # this shard's builder whitelist
+        self.connected = True; self.cooldown_until = 0.0; self.retry_at = 0.0
+        self.readable: Dict[int, bool] = {}; self.dialogs_loaded = False
+
+class ShardPool:
+    """Watched groups split across accounts, one TelegramClient per account in this loop.
+    A group goes to the least-loaded healthy shard whose account can read it; a shard in
+    FloodWait cooldown or disconnected hands its groups to the others (with a backfill
+    of the gap), and the load is levelled again once it is back."""
+    def __init__(self, clients: List[TelegramClient], index: WatchIndex, bot: "SimpleBot"):
+        self.shards = [Shard(n, c) for n, c in enumerate(clients)]
+        self.primary = clients[0]
+        self.index = index; self.bot = bot
+        self.owner: Dict[int, Shard] = {}
+        self.recovery: Optional[GapRecovery] = None
+        self._kick = asyncio.Event()
+        self._saved: Dict[str, int] = {}
+        for sh in self.shards: sh.client.on_flood = lambda secs, sh=sh: self.on_flood(sh, secs)
+    def attach(self, handler):
+        for sh in self.shards:
+            sh.client.add_event_handler(handler, RoutedNewMessage(self.index, chats=sh.peers))
+            sh.client.add_event_handler(handler, RoutedMessageEdited(self.index, chats=sh.peers))
+    async def start(self):
+        # account names for /shards; also checks the extra sessions are usable
+        async def me(sh: Shard):
+            try:
+                u = await sh.client.get_me()
+                sh.name = f"#{sh.n} @{u.username}" if getattr(u, "username", None) else f"#{sh.n} id={u.id}"
+            except Exception as e: print(f"[SHARD][WARN] {sh.name}: {e}")
+        await asyncio.gather(*(me(sh) for sh in self.shards))
+    def client_for(self, peer_id: int) -> TelegramClient:
+        sh = self.owner.get(peer_id)
+        return sh.client if sh else self.primary
+    def healthy(self, sh: Shard) -> bool:
+        return sh.connected and time.monotonic() >= sh.cooldown_until
+    def on_flood(self, sh: Shard, seconds: int):
+        sh.cooldown_until = max(sh.cooldown_until, time.monotonic() + seconds)
+        METRICS.inc("shard_floodwaits_total")
+        if len(self.shards) > 1: print(f"[SHARD][WARN] {sh.name} FloodWait {seconds}s; moving its groups meanwhile.")
+        self.kick()
+    def kick(self): self._kick.set()
+    async def can_read(self, sh: Shard, peer_id: int) -> bool:
+        # the account must be a member: it only gets updates for chats it is in
+        ok = sh.readable.get(peer_id)
+        if ok is not None: return ok
+        try:
+            try: peer = await sh.client.get_input_entity(peer_id)
+            except ValueError:
+                if sh.dialogs_loaded: raise
+                sh.dialogs_loaded = True; await sh.client.get_dialogs(limit=None)  # fills this account's entity cache
+                peer = await sh.client.get_input_entity(peer_id)
+            await sh.client.get_messages(peer, limit=1); ok = True
+        except FloodWaitError as e: report_flood(sh.client, e); return False  # unknown yet, ask again later
+        except Exception: ok = False
+        sh.readable[peer_id] = ok
+        return ok
+    def _move(self, peer_id: int, to: Optional[Shard]):
+        old = self.owner.pop(peer_id, None)
+        if old: old.peers.discard(peer_id)
+        if to: self.owner[peer_id] = to; to.peers.add(peer_id)
+    async def _pick(self, peer_id: int, exclude: Optional[Shard] = None) -> Optional[Shard]:
+        cands = sorted((sh for sh in self.shards if sh is not exclude and self.healthy(sh)), key=lambda sh: len(sh.peers))
+        if len(self.shards) == 1: return cands[0] if cands else None
+        for sh in cands:
+            if await self.can_read(sh, peer_id): return sh
+        return None
+    def place_new(self):
+        # no network: unassigned groups go to the primary account, which resolved them and so can
+        # read them; sync() checks the other accounts and spreads the load in the background
+        for peer_id in self.index.routes:
+            if peer_id not in self.owner: self._move(peer_id, self.shards[0])
+    async def sync(self):
+        for peer_id in [p for p in self.owner if p not in self.index.routes]: self._move(peer_id, None)
+        self.place_new()
+        moved: List[int] = []
+        for peer_id in list(self.index.routes):
+            cur = self.owner.get(peer_id)
+            if cur is not None and self.healthy(cur): continue
+            to = await self._pick(peer_id, exclude=cur)
+            if to is None:
+                if cur is None: self._move(peer_id, self.shards[0])  # nobody healthy: park it, retry later
+                continue
+            if cur is not None: moved.append(peer_id)
+            self._move(peer_id, to)
+        # level the load: move one group at a time from the busiest to the idlest healthy shard
+        while len(self.shards) > 1:
+            live = [sh for sh in self.shards if self.healthy(sh)]
+            if len(live) < 2: break
+            hi = max(live, key=lambda sh: len(sh.peers)); lo = min(live, key=lambda sh: len(sh.peers))
+            if len(hi.peers) - len(lo.peers) <= 1: break
+            peer_id = next((p for p in hi.peers if lo.readable.get(p) is not False), None)
+            if peer_id is None or not await self.can_read(lo, peer_id): break
+            self._move(peer_id, lo); moved.append(peer_id)
+        if moved:
+            print(f"[SHARD] Moved {len(moved)} group(s): " + ", ".join(f"{self.index.title(p)}→{self.owner[p].name}" for p in moved))
+            METRICS.inc("shard_moves_total", len(moved))
+            if self.recovery: self.recovery.mark_gap(moved); self.recovery.request()
+        state = {str(p): sh.n for p, sh in self.owner.items()}
+        if state != self._saved:
+            self._saved = state; self.bot.state["shards"] = state; self.bot._save_state("shards")
+    def load_state(self, data: Optional[Dict[str, Any]]):
+        # saved assignment is trusted at startup; sync() repairs it if a shard is gone
+        for p, n in (data or {}).items():
+            if int(n) < len(self.shards) and int(p) in self.index.routes: self._move(int(p), self.shards[int(n)])
+        self._saved = {str(p): sh.n for p, sh in self.owner.items()}
+    async def _reconnect(self, sh: Shard):
+        sh.retry_at = time.monotonic() + 30.0
+        try: await sh.client.connect()
+        except Exception as e: print(f"[SHARD][WARN] {sh.name} reconnect failed: {e}")
+    async def run(self, poll: float = 2.0):
+        while True:
+            for sh in self.shards:
+                now = sh.client.is_connected()
+                if sh.connected and not now:
+                    print(f"[SHARD] {sh.name} disconnected; will catch up on reconnect.")
+                    if self.recovery: self.recovery.mark_gap(sh.peers)
+                elif now and not sh.connected and self.recovery: self.recovery.request()
+                sh.connected = now
+                # Telethon gives up after its own retries; keep knocking for the extra accounts
+                if not now and sh.client is not self.primary and time.monotonic() >= sh.retry_at:
+                    asyncio.create_task(self._reconnect(sh))
+            try: await self.sync()
+            except Exception as e: print(f"[SHARD][ERROR] sync: {e}")
+            self._kick.clear()
+            try: await asyncio.wait_for(self._kick.wait(), poll)
+            except asyncio.TimeoutError: pass
+    def describe(self) -> str:
+        lines = []
+        for sh in self.shards:
+            state = "ok" if self.healthy(sh) else "disconnected" if not sh.connected else f"cooldown {sh.cooldown_until - time.monotonic():.0f}s"
+            lines.append(f"• {sh.name}: {state}, {len(sh.peers)} group(s)")
+        return "\n".join(lines)
+
+# --- Supervisor ---
+class Probe:
+    __slots__ = ("name", "check", "on_down", "fails", "failures", "down_since", "last_error")
+    def __init__(self, name: str, check, on_down=None, fails: int = 2):
+        self.name = name; self.check = check; self.on_down = on_down; self.fails = fails
+        self.failures = 0; self.down_since: Optional[float] = None; self.last_error = ""
+
+class Supervisor:
+    """Keeps the long-running loops ("legs") alive and watches liveness.
+
+    A leg that returns or raises is restarted after a jittered exponential backoff, which starts
+    over once the leg has stayed up for `stable` seconds. Fatal errors (see is_transient) are
+    retried at the backoff ceiling. Probes run every `every` seconds; after `fails` misses in a
+    row the path counts as degraded and `notify` gets one notice, and one more on recovery.
+    """
+    def __init__(self, notify, every: float = PROBE_INTERVAL_SECONDS, timeout: float = PROBE_TIMEOUT_SECONDS,
+                 stable: float = 60.0):
+        self.notify = notify; self.every = every; self.timeout = timeout; self.stable = stable
+        self.legs: Dict[str, Any] = {}
+        self.probes: List[Probe] = []
+        self.restarts: Dict[str, int] = {}
+    def leg(self, name: str, factory):
+        # factory() returns a fresh coroutine on every (re)start
+        self.legs[name] = factory
+    def probe(self, name: str, check, on_down=None, fails: int = 2):
+        self.probes.append(Probe(name, check, on_down, fails))
+    def degraded(self) -> List[str]:
+        return [p.name for p in self.probes if p.down_since is not None]
+    async def _run_leg(self, name: str, factory):
+        backoff = Backoff()
+        while True:
+            t0 = time.monotonic(); err: Optional[Exception] = None
+            try: await factory()
+            except asyncio.CancelledError: raise
+            except Exception as e: err = e
+            if time.monotonic() - t0 >= self.stable: backoff.reset()
+            kind = "ended" if err is None else "transient" if is_transient(err) else "fatal"
+            delay = backoff.next()
+            if kind == "fatal":
+                delay = backoff.cap
+                if not self.restarts.get(name): self.notify(f"⛔ {name} stopped: {err}\nRetrying every {delay:.0f}s; check the configuration.")
+            self.restarts[name] = self.restarts.get(name, 0) + 1
+            METRICS.inc("supervisor_restarts_total", leg=name, kind=kind)
+            print(f"[SUPERVISOR][{'ERROR' if kind == 'fatal' else 'WARN'}] {name} {kind}" + (f": {err}" if err else "") + f"; restarting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+    async def _check(self, p: Probe):
+        t0 = time.perf_counter()
+        try: await asyncio.wait_for(p.check(), self.timeout); ok = True
+        except asyncio.CancelledError: raise
+        except Exception as e: ok = False; p.last_error = str(e) or type(e).__name__
+        METRICS.observe("probe_seconds", time.perf_counter() - t0, probe=p.name)
+        if ok:
+            p.failures = 0
+            if p.down_since is not None:
+                took = time.monotonic() - p.down_since; p.down_since = None
+                METRICS.observe("recovery_seconds", took, probe=p.name)
+                print(f"[SUPERVISOR] {p.name} recovered after {took:.0f}s")
+                self.notify(f"✅ {p.name} is back after {took:.0f}s.")
+            return
+        p.failures += 1; METRICS.inc("probe_failures_total", probe=p.name)
+        print(f"[SUPERVISOR][WARN] {p.name} probe failed ({p.failures}): {p.last_error}")
+        if p.failures == p.fails:
+            p.down_since = time.monotonic() - (p.fails - 1) * self.every
+            self.notify(f"⚠️ {p.name} is not responding ({p.last_error}). Alerts may be delayed; reconnecting.")
+        if p.failures >= p.fails and p.on_down:
+            try: await p.on_down()
+            except Exception as e: print(f"[SUPERVISOR][WARN] {p.name} recovery: {e}")
+    async def _run_probes(self):
+        while True:
+            await asyncio.sleep(self.every)
+            await asyncio.gather(*(self._check(p) for p in self.probes))
+    async def run(self):
+        tasks = [self._run_leg(n, f) for n, f in self.legs.items()]
+        if self.probes and self.every > 0: tasks.append(self._run_probes())
+        await asyncio.gather(*tasks)
 
 # --- Main ---
 async def main():
-    global NAG_INTERVAL_SECONDS
+    global NAG_INTERVAL_SECONDS, MAX_NAGS
+    check_config()
 
-    # client
-    session = StringSession(STRING_SESSION) if STRING_SESSION else SESSION_FILE
-    client = TelegramClient(session, API_ID, API_HASH)
-    await client.start()
+    t_start = time.perf_counter(); timings: Dict[str, float] = {}
+    async def timed(name: str, coro):
+        t0 = time.perf_counter()
+        try: return await coro
+        finally: timings[name] = time.perf_counter() - t0
 
-    # bot
+    # client login and bot/state load overlap
+    session = StringSession(STRING_SESSION) if STRING_SESSION else SESSION_FILE
+    # with extra accounts, short FloodWaits are slept inside Telethon and longer ones move groups
+    flood = {"flood_sleep_threshold": SHARD_FLOOD_SLEEP} if EXTRA_SESSIONS else {}
+    client = TelegramClient(session, API_ID, API_HASH, **flood)
+    extra = [TelegramClient(StringSession(x) if len(x) > 100 else x, API_ID, API_HASH, **flood) for x in EXTRA_SESSIONS]
     bot = SimpleBot(BOT_TOKEN, STATE_PATH, chat_id_env=BOT_CHAT_ID_ENV)
-    await bot.start()
+    async def start_extra(c: TelegramClient):
+        # extra accounts must already be logged in; they are never prompted for a code
+        try:
+            await c.connect()
+            if await c.is_user_authorized(): return c
+            print("[SHARD][WARN] An extra session is not authorized; skipping it.")
+        except Exception as e: print(f"[SHARD][WARN] Could not start an extra session: {e}")
+        await c.disconnect()
+    started = await asyncio.gather(timed("login", client.start()), timed("state", bot.start()), *(start_extra(c) for c in extra))
+    extra = [c for c in started[2:] if c is not None]
 
     # restore interval if saved
     si = bot.state.get("nag_interval")
     if isinstance(si, int) and si >= 30: NAG_INTERVAL_SECONDS = si
+    sm = bot.state.get("max_nags")
+    if isinstance(sm, int) and sm >= 0: MAX_NAGS = sm
 
-    # load saved group/user
-    saved_group_link = bot.state.get("group_link")
-    saved_group_peer_id = bot.state.get("group_peer_id")
-    saved_target_id = bot.state.get("target_id")
-    saved_target_username = bot.state.get("target_username")
+    # load saved groups/users; saved access hashes let Telethon use them without a lookup
+    t0 = time.perf_counter()
+    index = WatchIndex()
+    index.load_state(bot.state)
+    # only ids the session lacks (a fresh StringSession): rows from bare InputPeers have no
+    # username or name, so they must not overwrite what a session file already holds
+    client.session.process_entities([p for p in index.input_peers() if not client.session.get_entity_rows_by_id(get_peer_id(p))])
+    if any(k in bot.state for k in LEGACY_STATE_KEYS): save_index(bot, index)
+    rules = RuleBook()
+    rules.load_state(bot.state.get("rules"))
+    subs = Subscribers(bot)
+    subs.load_state(bot.state.get("subscribers"))
+    dialogs = DialogIndex()
+    archive = Archive(ARCHIVE_PATH) if ARCHIVE_PATH else None
+    if archive:
+        try: await archive.start()
+        except Exception as e: print(f"[ARCHIVE][WARN] Archive disabled: {e}"); archive = None
+    timings["index"] = time.perf_counter() - t0
 
-    group = None; group_title = ""; group_peer_id = None
+    async def lookup(coro):
+        # bounded: a slow invite import or FloodWait must not hold up the serial lane for long
+        try: return await asyncio.wait_for(coro, COMMAND_TIMEOUT)
+        except asyncio.TimeoutError: raise TimeoutError(f"Telegram did not answer within {COMMAND_TIMEOUT:g}s") from None
 
-    # resolve group from state or env
-    try_candidates = []
-    if saved_group_link: try_candidates.append(("state_link", saved_group_link))
-    if GROUP_INVITE: try_candidates.append(("env_link", GROUP_INVITE))
-    for origin, val in try_candidates:
-        try:
-            ent = await resolve_group_entity(client, val)
-            g = ensure_group_entity(ent)
-            if g:
-                group = g
-                group_title = getattr(group, "title", None) or str(getattr(group, "id", "group"))
-                group_peer_id = get_peer_id(group)
-                print(f"[INFO] Monitoring group ({origin}): {group_title} (peer_id={group_peer_id})")
-                bot.state["group_link"] = val
-                bot.state["group_title"] = group_title
-                bot.state["group_peer_id"] = group_peer_id
-                bot._save_state()
-                break
-        except Exception as e:
-            print(f"[WARN] Could not resolve {origin}: {e}")
-    if group is None and saved_group_peer_id:
-        # We still need the entity for title; try to resolve by dialogs
-        async for d in client.iter_dialogs(limit=200):
-            if get_peer_id(d.entity) == int(saved_group_peer_id):
-                group = d.entity; group_title = d.name; group_peer_id = int(saved_group_peer_id)
-                print(f"[INFO] Monitoring group (state peer): {group_title} (peer_id={group_peer_id})")
-                break
-    if group is None:
-        print("[WARN] No group configured yet. Use /setgroup <invite|@public|id> in the bot chat.")
-
-    # resolve target user
-    target_id = None; target_username = None
     async def resolve_user(identifier: str):
-        nonlocal target_id, target_username
         s = identifier.strip().lstrip("@")
-        u = await client.get_entity(int(s)) if s.isdigit() else await client.get_entity(s)
-        target_id = u.id; target_username = getattr(u, "username", None)
+        if not s.isdigit():
+            uid = index.entities.id_for(s)
+            if uid is not None: return uid, s
+        u = await lookup(client.get_entity(int(s) if s.isdigit() else s))
+        index.entities.put(u.id, getattr(u, "username", None)); index.remember_peer(u)
+        return u.id, getattr(u, "username", None)
 
-    if saved_target_id or saved_target_username:
-        try: await resolve_user(str(saved_target_id or saved_target_username))
-        except: pass
-    if target_id is None and TARGET_USERNAME:
-        try:
-            await resolve_user(TARGET_USERNAME)
-        except Exception as e:
-            print(f"[WARN] TARGET_USERNAME couldn't be resolved: {e}. Use /setuser in the bot chat.")
+    async def add_group_from(value: str, link: str = ""):
+        ent = await lookup(resolve_group_entity(client, value))
+        g = ensure_group_entity(ent)
+        if not g: return None
+        title = getattr(g, "title", None) or str(getattr(g, "id", "group"))
+        peer_id = get_peer_id(g)
+        index.add_group(peer_id, title, link); index.remember_peer(g); dialogs.add(g)
+        return peer_id
 
-    if target_id: print(f"[INFO] Watching for messages from: @{target_username or TARGET_USERNAME} (id={target_id})")
+    # env group/user seed the index the first time; runs after the bot is already up
+    async def seed_from_env(args: List[str], chat: Dict[str, Any]):
+        t0 = time.perf_counter()
+        # TARGET_USERNAME goes to the env group (already watched or resolved below), else the current one
+        seeded = next((p for p, g in index.groups.items() if g.get("link") == GROUP_INVITE), None) if GROUP_INVITE else index.current
+        need_group = bool(GROUP_INVITE) and seeded is None
+        need_user = TARGET_USERNAME and (need_group or (seeded is not None and not index.routes[seeded] and seeded not in index.pending))
+        if not need_group and not need_user: return
+        # the two lookups are independent, so run them together
+        group_res, user_res = await asyncio.gather(
+            lookup(resolve_group_entity(client, GROUP_INVITE)) if need_group else asyncio.sleep(0),
+            resolve_user(TARGET_USERNAME) if need_user else asyncio.sleep(0),
+            return_exceptions=True)
+        if need_group:
+            g = None if isinstance(group_res, Exception) else ensure_group_entity(group_res)
+            if isinstance(group_res, Exception): print(f"[WARN] Could not resolve env_link: {group_res}")
+            elif g is None: print("[WARN] GROUP_INVITE resolved to a USER, not a group.")
+            else:
+                seeded = get_peer_id(g)
+                index.add_group(seeded, getattr(g, "title", None) or str(g.id), GROUP_INVITE, make_current=False); index.remember_peer(g)
+        if need_user and seeded is not None:
+            if isinstance(user_res, Exception):
+                if not TARGET_USERNAME.isdigit(): index.add_pending(seeded, TARGET_USERNAME)
+                print(f"[WARN] TARGET_USERNAME couldn't be resolved: {user_res}. Matching by username until they post.")
+            else:
+                uid, uname = user_res; index.add_target(seeded, uid, uname or TARGET_USERNAME)
+        save_index(bot, index); pool.kick(); log_routes()
+        print(f"[STARTUP] Resolved env group/user in {time.perf_counter() - t0:.2f}s")
 
-    alert = AlertState()
+    def log_routes():
+        if not index.routes:
+            print("[WARN] No group configured yet. Use /setgroup <invite|@public|id> in the bot chat.")
+        for peer_id, ids in index.routes.items():
+            users = ", ".join([index.who(u) for u in sorted(ids)] + [f"@{n}" for n in sorted(index.pending.get(peer_id, ()))]) or "(no users)"
+            print(f"[INFO] Monitoring group: {index.title(peer_id)} (peer_id={peer_id}) for {users}")
+    log_routes()
 
-    # ---- bot loop ----
-    async def bot_updates_loop():
-        global NAG_INTERVAL_SECONDS
-        nonlocal group, group_title, group_peer_id, target_id, target_username
-
-        HELP = (
-            "Commands:\n"
-            "/start – register chat\n"
-            "/stop – stop alerts\n"
-            "/status – show status\n"
-            "/interval <minutes>\n"
-            "/setgroup <invite|@public|id>\n"
-            "/listgroups\n"
-            "/usegroup <peer_id>\n"
-            "/setuser <@username|id>\n"
-            "/reset\n"
-            "/test\n"
+    alerts = AlertScheduler()
+
+    def parse_peer(args: List[str], i: int) -> Optional[int]:
+        if len(args) <= i: return None
+        peer_id = int(args[i])
+        if peer_id not in index.routes: raise ValueError(f"peer_id={peer_id} is not watched")
+        return peer_id
+
+    # ---- bot commands (shared by polling and webhook) ----
+    HELP = (
+        "Commands:\n"
+        "/start – subscribe this chat to alerts (BOT_CHAT_ID / ALLOWED_CHAT_IDS only)\n"
+        "/unsubscribe – stop receiving alerts here\n"
+        "/subs – subscribers and delivery results\n"
+        "/stop [peer_id|all] – stop your alerts (all, or for one group); all = everyone's\n"
+        "/status – show status\n"
+        "/stats – latency and throughput metrics\n"
+        "/shards – accounts and how groups are split across them\n"
+        "/search <words|\"phrase\"|prefix*> – search archived messages\n"
+        "/last [n] [all] – latest archived triggers (all = every archived message)\n"
+        "/interval <minutes|off> [peer_id|me]\n"
+        "/maxnags <n|off> [peer_id|me] – 0 = unlimited; me = only your alerts\n"
+        "/setgroup <invite|@public|id> – watch a group\n"
+        "/listgroups [page] [filter] | refresh\n"
+        "/usegroup <peer_id> – watch/select a group\n"
+        "/usegroup del <peer_id> – stop watching a group\n"
+        "/setuser <@username|id> [peer_id] – watch a user in the selected group\n"
+        "/setuser del <@username|id> [peer_id]\n"
+        "/rules – show filter rules\n"
+        "/rule <*|peer_id|peer_id:user_id> <any|words|none|media> <a, b, …>\n"
+        "/rule <scope> regex <pattern> | hours <08:00-20:00> | clear [field]\n"
+        "/reset\n"
+        "/test\n"
+    )
+
+    commands = CommandRegistry()
+    commands.allow = subs.allowed
+
+    @commands.command("/start", lane="high", public=True)
+    async def cmd_start(args: List[str], chat: Dict[str, Any]):
+        chat_id = chat.get("id")
+        if not chat_id: return
+        if not subs.claim(chat_id):
+            print(f"[BOT][WARN] /start from chat {chat_id} refused (not in ALLOWED_CHAT_IDS)")
+            bot.send_message(f"This bot is private. Ask its owner to add {chat_id} to ALLOWED_CHAT_IDS."); return
+        name = chat.get("username") or chat.get("title") or chat.get("first_name") or ""
+        new = subs.add(chat_id, name); subs.save()
+        bot.send_message(f"{'Subscribed' if new else 'Already subscribed'} ({len(subs)} subscriber(s)). /help for commands.")
+
+    @commands.command("/unsubscribe")
+    async def cmd_unsubscribe(args: List[str], chat: Dict[str, Any]):
+        chat_id = chat.get("id")
+        alerts.stop_where(lambda k: k[0] == chat_id)
+        if subs.remove(chat_id): subs.save(); bot.send_message("Unsubscribed. /start to subscribe again.")
+        else: bot.send_message("This chat is not subscribed.")
+
+    @commands.command("/subs", lane="high")
+    async def cmd_subs(args: List[str], chat: Dict[str, Any]):
+        if not subs.chats: bot.send_message("No subscribers. /start to subscribe."); return
+        lines = []
+        for chat_id, sub in subs.chats.items():
+            iv, mx = nag_settings(index, None, sub); mine = sum(1 for k in alerts.alerts if k[0] == chat_id)
+            lines.append(f"• {sub.get('name') or chat_id} ({chat_id}): {iv}s, max {mx or '∞'}, {mine} alert(s), {subs.delivery_stats(chat_id)}")
+        bot.send_message(safe_slice("Subscribers:\n" + "\n".join(lines), BOT_MESSAGE_LIMIT))
+
+    @commands.command("/help", lane="high")
+    async def cmd_help(args: List[str], chat: Dict[str, Any]):
+        bot.send_message(HELP)
+
+    @commands.command("/stop", lane="high")
+    async def cmd_stop(args: List[str], chat: Dict[str, Any]):
+        if len(args) >= 2 and args[1].lower() == "all":
+            bot.send_message(f"All alerts stopped ({alerts.stop()})."); return
+        try: peer_id = int(args[1]) if len(args) >= 2 else None
+        except ValueError: bot.send_message("Usage: /stop [peer_id|all]"); return
+        chat_id = chat.get("id")
+        n = alerts.stop_where(lambda k: k[0] == chat_id and (peer_id is None or k[1] == peer_id))
+        bot.send_message(f"Alerts stopped ({n}).")
+
+    @commands.command("/status", lane="high")
+    async def cmd_status(args: List[str], chat: Dict[str, Any]):
+        status = f"active ({len(alerts)} alert(s))" if len(alerts) else "idle"
+        lines = []
+        for peer_id, ids in index.routes.items():
+            mark = "*" if peer_id == index.current else "•"
+            if index.groups.get(peer_id, {}).get("interval") or "max_nags" in index.groups.get(peer_id, {}):
+                iv, mx = nag_settings(index, peer_id); mark += f" [{iv}s, max {mx or '∞'}]"
+            users = [f"{index.who(u)} (id={u})" for u in sorted(ids)]
+            users += [f"@{n} (pending)" for n in sorted(index.pending.get(peer_id, ()))]
+            users = ", ".join(users) or "(no users)"
+            lines.append(f"{mark} {index.title(peer_id)} (peer_id={peer_id}): {users}")
+        ginfo = "\n".join(lines) if lines else "• unset"
+        bot.send_message(
+            f"Status: {status}\nWatching {len(index.routes)} group(s), {index.pair_count()} pair(s):\n{ginfo}\n• Interval: {NAG_INTERVAL_SECONDS}s, max nags: {MAX_NAGS or '∞'}\n• Subscribers: {len(subs.ids())}\n• Connections: {', '.join(sup.degraded()) + ' degraded' if sup.degraded() else 'ok'}\n• Nags sent: {sum(a.count for a in alerts.alerts.values())}\n• Entity cache: {index.entities.stats()}"
         )
-        while True:
-            updates = await bot.get_updates(timeout=50)
-            for upd in updates:
-                bot.update_offset = upd["update_id"] + 1
-                msg = upd.get("message") or upd.get("edited_message")
-                if not msg: continue
-                chat = msg.get("chat", {}); text = (msg.get("text") or "").strip()
-                args = text.split(); cmd = args[0].lower() if args else ""
-
-                if cmd == "/start":
-                    bot.chat_id = chat.get("id"); bot._save_state()
-                    await bot.send_message("Registered. /help for commands.")
-                    continue
-                if cmd == "/help":
-                    await bot.send_message(HELP); continue
-                if cmd == "/stop":
-                    alert.stop(); await bot.send_message("Alerts stopped."); continue
-                if cmd == "/status":
-                    status = "active" if alert.nag_active else "idle"
-                    ginfo = f"{group_title} (peer_id={group_peer_id})" if group_peer_id else "unset"
-                    uinfo = f"@{target_username or TARGET_USERNAME} (id={target_id})" if target_id else "unset"
-                    await bot.send_message(
-                        f"Status: {status}\n• Group: {ginfo}\n• User: {uinfo}\n• Interval: {NAG_INTERVAL_SECONDS}s\n• Cycle count: {alert.nag_count}"
-                    )
-                    continue
-                if cmd == "/interval":
-                    if len(args) >= 2:
-                        try:
-                            minutes = float(args[1]); NAG_INTERVAL_SECONDS = int(max(30, minutes*60))
-                            bot.state["nag_interval"] = NAG_INTERVAL_SECONDS; bot._save_state()
-                            await bot.send_message(f"Interval set to {minutes:g} min ({NAG_INTERVAL_SECONDS}s).")
-                        except: await bot.send_message("Usage: /interval <minutes>")
-                    else: await bot.send_message("Usage: /interval <minutes>")
-                    continue
-                if cmd == "/setgroup":
-                    if len(args) >= 2:
-                        try:
-                            raw = " ".join(args[1:])
-                            ent = await resolve_group_entity(client, raw)
-                            g = ensure_group_entity(ent)
-                            if not g:
-                                await bot.send_message("That resolves to a USER, not a group. Use an invite link or /listgroups + /usegroup <peer_id>.")
-                                continue
-                            group = g; group_title = getattr(group,"title",None) or str(getattr(group,"id","group"))
-                            group_peer_id = get_peer_id(group)
-                            bot.state["group_link"] = raw; bot.state["group_title"] = group_title; bot.state["group_peer_id"] = group_peer_id; bot._save_state()
-                            await bot.send_message(f"Group set: {group_title} (peer_id={group_peer_id})")
-                        except Exception as e:
-                            await bot.send_message(f"Could not set group: {e}")
-                    else: await bot.send_message("Usage: /setgroup <invite|@public|id>")
-                    continue
-                if cmd == "/listgroups":
-                    try:
-                        lines = []
-                        async for d in client.iter_dialogs(limit=100):
-                            ent = d.entity
-                            if isinstance(ent, (Chat, Channel)):
-                                lines.append(f"{get_peer_id(ent)}\t{d.name}")
-                        if not lines: await bot.send_message("No groups found.")
-                        else:
-                            buf=[]; 
-                            for line in lines:
-                                buf.append(line)
-                                if len("\n".join(buf))>3500: await bot.send_message("Groups (peer_id\\ttitle):\n"+"\n".join(buf)); buf=[]
-                            if buf: await bot.send_message("Groups (peer_id\\ttitle):\n"+"\n".join(buf))
-                            await bot.send_message("Use /usegroup <peer_id> to switch.")
-                    except Exception as e:
-                        await bot.send_message(f"Could not list groups: {e}")
-                    continue
-                if cmd == "/usegroup":
-                    if len(args) >= 2:
-                        try:
-                            ent = await resolve_group_entity(client, args[1])
-                            g = ensure_group_entity(ent)
-                            if not g:
-                                await bot.send_message("That id resolves to a USER, not a group. Use a negative peer_id.")
-                                continue
-                            group = g; group_title = getattr(group,"title",None) or str(getattr(group,"id","group"))
-                            group_peer_id = get_peer_id(group)
-                            bot.state["group_link"] = ""  # set via id
-                            bot.state["group_title"] = group_title
-                            bot.state["group_peer_id"] = group_peer_id
-                            bot._save_state()
-                            await bot.send_message(f"Group set: {group_title} (peer_id={group_peer_id})")
-                        except Exception as e:
-                            await bot.send_message(f"Could not set group by id: {e}")
-                    else: await bot.send_message("Usage: /usegroup <peer_id>")
-                    continue
-                if cmd == "/setuser":
-                    if len(args) >= 2:
-                        try:
-                            who = args[1].lstrip("@")
-                            u = await client.get_entity(int(who)) if who.isdigit() else await client.get_entity(who)
-                            target_id = u.id; target_username = getattr(u,"username",None)
-                            bot.state["target_id"] = target_id; bot.state["target_username"] = target_username or who; bot._save_state()
-                            await bot.send_message(f"User set: @{target_username or who} (id={target_id})")
-                        except Exception as e:
-                            await bot.send_message(f"Could not set user: {e}")
-                    else: await bot.send_message("Usage: /setuser <@username|id>")
-                    continue
-                if cmd == "/reset":
-                    try:
-                        alert.stop()
-                        NAG_INTERVAL_SECONDS = DEFAULT_NAG_INTERVAL_SECONDS
-                        bot.state["nag_interval"] = NAG_INTERVAL_SECONDS
-                        if GROUP_INVITE:
-                            ent = await resolve_group_entity(client, GROUP_INVITE)
-                            g = ensure_group_entity(ent)
-                            if not g: raise RuntimeError("GROUP_INVITE resolved to a USER.")
-                            group = g; group_title = getattr(group,"title",None) or str(getattr(group,"id","group"))
-                            group_peer_id = get_peer_id(group)
-                            bot.state["group_link"]=GROUP_INVITE; bot.state["group_title"]=group_title; bot.state["group_peer_id"]=group_peer_id
-                        if TARGET_USERNAME:
-                            who = TARGET_USERNAME.lstrip("@")
-                            u = await client.get_entity(int(who)) if who.isdigit() else await client.get_entity(who)
-                            target_id = u.id; target_username = getattr(u,"username",None)
-                            bot.state["target_id"]=target_id; bot.state["target_username"]=target_username or who
-                        bot._save_state()
-                        await bot.send_message("Reset done.")
-                    except Exception as e:
-                        await bot.send_message(f"Reset failed: {e}")
-                    continue
-                if cmd == "/test":
-                    alert.start(f"Manual test at {time.strftime('%Y-%m-%d %H:%M:%S')}")
-                    await bot.send_message("Test alerts started. Send /stop to stop.")
-                    continue
-            await asyncio.sleep(0.5)
-
-    # ---- nag loop ----
-    async def nag_loop():
-        while True:
-            if alert.nag_active and bot.chat_id:
-                now = time.time()
-                if alert.last_nag_sent_at == 0.0 or (now - alert.last_nag_sent_at) >= NAG_INTERVAL_SECONDS:
-                    who = f"@{target_username or TARGET_USERNAME}" if target_id else "(unset user)"
-                    where = group_title or "(unset group)"
-                    await bot.send_message(NAG_MESSAGE_TEMPLATE.format(who=who, where=where))
-                    alert.last_nag_sent_at = now; alert.nag_count += 1
-                    if MAX_NAGS and alert.nag_count >= MAX_NAGS:
-                        alert.stop(); await bot.send_message("⛔ Max nags reached.")
-            await asyncio.sleep(1.0)
 
-    # ---- triggers ----
-    @client.on(events.NewMessage)
-    async def on_new_message(event):
-        if not group_peer_id or not target_id: return
-        if event.chat_id != group_peer_id: return  # *** FIX: compare peer ids ***
+    @commands.command("/shards", lane="high")
+    async def cmd_shards(args: List[str], chat: Dict[str, Any]):
+        bot.send_message(f"Accounts ({len(pool.shards)}):\n{pool.describe()}")
 
-        try: sender = await event.get_sender()
-        except Exception: sender = None
+    def archive_lines(rows) -> List[str]:
+        lines = []
+        for peer_id, msg_id, sender_id, date, text in rows:
+            when = datetime.fromtimestamp(date).strftime("%Y-%m-%d %H:%M")
+            uname = index.targets.get(sender_id) or index.entities.get(sender_id)
+            who = f"@{uname}" if uname else f"id={sender_id}"
+            link = build_message_link(peer_id, msg_id)
+            lines.append(f"\n🕒 {when} · {who} · {index.title(peer_id)}\n{safe_slice(text or '(no text)', 600)}" + (f"\n🔗 {link}" if link else ""))
+        return lines
 
-        is_from_target = False
-        if sender:
-            if sender.id == target_id: is_from_target = True
-            elif target_username and getattr(sender,"username",None):
-                is_from_target = sender.username.lower() == target_username.lower()
+    @commands.command("/search", lane="slow")
+    async def cmd_search(args: List[str], chat: Dict[str, Any]):
+        if archive is None: bot.send_message("The archive is off (ARCHIVE_PATH is empty)."); return
+        if len(args) < 2: bot.send_message("Usage: /search <query>"); return
+        t0 = time.perf_counter()
+        rows = await archive.search(" ".join(args[1:]), 10)
+        ms = 1000 * (time.perf_counter() - t0)
+        if not rows: bot.send_message(f"No matches ({ms:.0f} ms)."); return
+        for part in split_message(f"🔎 {len(rows)} match(es) in {ms:.0f} ms", archive_lines(rows)): bot.send_message(part)
 
-        if not is_from_target: return
+    @commands.command("/last", lane="slow")
+    async def cmd_last(args: List[str], chat: Dict[str, Any]):
+        if archive is None: bot.send_message("The archive is off (ARCHIVE_PATH is empty)."); return
+        n = next((int(a) for a in args[1:] if a.isdigit()), 5)
+        every = any(a.lower() == "all" for a in args[1:])
+        rows = await archive.last(max(1, min(n, 50)), triggered_only=not every)
+        if not rows: bot.send_message("Nothing archived yet."); return
+        for part in split_message(f"🗂 Last {len(rows)} {'message(s)' if every else 'trigger(s)'}", archive_lines(rows[::-1])): bot.send_message(part)
 
-        # optional keyword filter
-        if REQUIRED_KEYWORDS:
-            body = (event.raw_text or "").lower()
-            if not any(k in body for k in REQUIRED_KEYWORDS): return
+    @commands.command("/stats", lane="high")
+    async def cmd_stats(args: List[str], chat: Dict[str, Any]):
+        bot.send_message(safe_slice(METRICS.summary(), BOT_MESSAGE_LIMIT))
 
-        when = event.date.strftime("%Y-%m-%d %H:%M:%S") if event.date else "now"
-        alert.start(f"Message from @{target_username or TARGET_USERNAME} in {group_title} at {when}")
-
-        if bot.chat_id:
-            text = event.raw_text or "(no text)"
-            link = build_message_link(group_peer_id, getattr(event, 'id', None))
-            header = f"📨 Forwarded message\nFrom @{target_username or TARGET_USERNAME} in {group_title}\n🕒 {when}"
-            body = safe_slice(text, 3600)
-            tail = f"\n🔗 Open: {link}" if link else ""
-            media_note = "\n📎 (media present but not forwarded)" if event.message and event.message.media else ""
-            await bot.send_message(f"{header}\n\n{body}{media_note}{tail}")
-
-        who = f"@{target_username or TARGET_USERNAME}"
-        await bot.send_message(f"🚨 Trigger: {who} posted in {group_title} at {when}. I'll keep pinging you until you /stop.")
-
-    print("[READY] Listener is live. DM /start to your bot, then /setgroup and /setuser.")
-    await asyncio.gather(client.run_until_disconnected(), bot_updates_loop(), nag_loop())
+    @commands.command("/rules", lane="high")
+    async def cmd_rules(args: List[str], chat: Dict[str, Any]):
+        if not rules.specs:
+            bot.send_message(f"No rules. Default keywords: {', '.join(REQUIRED_KEYWORDS) or '(none)'}"); return
+        lines = []
+        for scope, spec in rules.specs.items():
+            lines.append(f"{scope}:")
+            lines += [f"  {k}: {', '.join(v) if isinstance(v, list) else v}" for k, v in spec.items()]
+        bot.send_message(safe_slice("\n".join(lines), BOT_MESSAGE_LIMIT))
+
+    @commands.command("/rule")
+    async def cmd_rule(args: List[str], chat: Dict[str, Any]):
+        usage = "Usage: /rule <*|peer_id|peer_id:user_id> <any|words|none|media|regex|hours|clear> <values>"
+        if len(args) < 3: bot.send_message(usage); return
+        scope, field, rest = args[1], args[2].lower(), " ".join(args[3:])
+        try: RuleBook.scope_key(scope)
+        except ValueError: bot.send_message(usage); return
+        spec = dict(rules.specs.get(scope, {}))
+        if field == "clear":
+            if rest: spec.pop(rest.lower(), None)
+            else: spec = {}
+        elif field in ("any", "words", "none"):
+            spec[field] = [v.strip() for v in rest.split(",") if v.strip()]
+        elif field == "media":
+            kinds = [v.strip().lower() for v in rest.split(",") if v.strip()]
+            bad = [k for k in kinds if k not in MEDIA_KINDS]
+            if bad: bot.send_message(f"Unknown media kind(s): {', '.join(bad)}. Use {', '.join(MEDIA_KINDS)}."); return
+            spec["media"] = kinds
+        elif field == "regex":
+            if not rest: bot.send_message(usage); return
+            spec["regex"] = list(spec.get("regex", [])) + [rest]
+        elif field == "hours":
+            spec["hours"] = rest
+        else: bot.send_message(usage); return
+        try: rules.set(scope, spec)
+        except Exception as e: bot.send_message(f"Rule not saved: {e}"); return
+        bot.state["rules"] = rules.to_state(); bot._save_state("rules")
+        bot.send_message(f"Rule for {scope} updated." if scope in rules.specs else f"Rule for {scope} cleared.")
+
+    @commands.command("/interval")
+    async def cmd_interval(args: List[str], chat: Dict[str, Any]):
+        global NAG_INTERVAL_SECONDS
+        if len(args) >= 3 and args[2].lower() == "me" and chat.get("id") in subs.chats:
+            sub = subs.chats[chat["id"]]
+            if args[1].lower() == "off": sub.pop("interval", None); bot.send_message("Your interval override is cleared.")
+            else:
+                try: minutes = float(args[1])
+                except ValueError: bot.send_message("Usage: /interval <minutes|off> me"); return
+                sub["interval"] = int(max(30, minutes*60)); bot.send_message(f"Your interval is {minutes:g} min ({sub['interval']}s).")
+            subs.save(); return
+        if len(args) >= 2:
+            try:
+                minutes = float(args[1]); seconds = int(max(30, minutes*60)); peer_id = parse_peer(args, 2)
+                if peer_id is None:
+                    NAG_INTERVAL_SECONDS = seconds; bot.state["nag_interval"] = seconds; bot._save_state("nag_interval")
+                else:
+                    index.groups[peer_id]["interval"] = seconds; save_index(bot, index)
+                where = f" for {index.title(peer_id)}" if peer_id is not None else ""
+                bot.send_message(f"Interval set to {minutes:g} min ({seconds}s){where}.")
+            except Exception: bot.send_message("Usage: /interval <minutes> [peer_id|me]")
+        else: bot.send_message("Usage: /interval <minutes> [peer_id|me]")
+
+    @commands.command("/maxnags")
+    async def cmd_maxnags(args: List[str], chat: Dict[str, Any]):
+        global MAX_NAGS
+        if len(args) >= 3 and args[2].lower() == "me" and chat.get("id") in subs.chats:
+            sub = subs.chats[chat["id"]]
+            if args[1].lower() == "off": sub.pop("max_nags", None); bot.send_message("Your max nags override is cleared.")
+            else:
+                try: sub["max_nags"] = max(0, int(args[1]))
+                except ValueError: bot.send_message("Usage: /maxnags <n|off> me"); return
+                bot.send_message(f"Your max nags is {sub['max_nags'] or 'unlimited'}.")
+            subs.save(); return
+        if len(args) >= 2:
+            try:
+                n = max(0, int(args[1])); peer_id = parse_peer(args, 2)
+                if peer_id is None:
+                    MAX_NAGS = n; bot.state["max_nags"] = n; bot._save_state("max_nags")
+                else:
+                    index.groups[peer_id]["max_nags"] = n; save_index(bot, index)
+                where = f" for {index.title(peer_id)}" if peer_id is not None else ""
+                bot.send_message(f"Max nags set to {n or 'unlimited'}{where}.")
+            except Exception: bot.send_message("Usage: /maxnags <n> [peer_id|me]")
+        else: bot.send_message("Usage: /maxnags <n> [peer_id|me]")
+
+    @commands.command("/setgroup")
+    async def cmd_setgroup(args: List[str], chat: Dict[str, Any]):
+        if len(args) >= 2:
+            try:
+                raw = " ".join(args[1:])
+                peer_id = await add_group_from(raw, raw)
+                if peer_id is None:
+                    bot.send_message("That resolves to a USER, not a group. Use an invite link or /listgroups + /usegroup <peer_id>.")
+                    return
+                save_index(bot, index); pool.kick()
+                bot.send_message(f"Group added: {index.title(peer_id)} (peer_id={peer_id}). /setuser now applies to it.")
+            except Exception as e:
+                bot.send_message(f"Could not set group: {e}")
+        else: bot.send_message("Usage: /setgroup <invite|@public|id>")
+
+    @commands.command("/listgroups", lane="slow")
+    async def cmd_listgroups(args: List[str], chat: Dict[str, Any]):
+        usage = "/listgroups [page] [filter] · /listgroups refresh"
+        if len(args) >= 2 and args[1].lower() == "refresh":
+            bot.send_message("Re-reading the group list…")
+            try: await dialogs.refresh(client)
+            except Exception as e: bot.send_message(f"Could not list groups: {e}"); return
+            bot.send_message(f"Group list refreshed: {len(dialogs)} group(s)."); return
+        if not dialogs.ready:
+            bot.send_message(f"Still reading the group list ({len(dialogs)} so far); try again in a moment."); return
+        page = int(args[1]) if len(args) >= 2 and args[1].isdigit() else 1
+        needle = " ".join(args[2:] if len(args) >= 2 and args[1].isdigit() else args[1:])
+        rows, page, pages, total = dialogs.page(page, needle)
+        if not rows: bot.send_message(f"No groups{' matching ' + repr(needle) if needle else ''} found. {usage}"); return
+        lines = [f"{p}\t{t}{' ✓' if p in index.routes else ''}" for p, t in rows]
+        footer = f"\nPage {page}/{pages} · {total} group(s){' matching ' + repr(needle) if needle else ''} · {usage}\nUse /usegroup <peer_id> to watch one (✓ = watched)."
+        for part in split_message("Groups (peer_id\ttitle):", lines + [footer]): bot.send_message(part)
+
+    @commands.command("/usegroup")
+    async def cmd_usegroup(args: List[str], chat: Dict[str, Any]):
+        if len(args) >= 3 and args[1].lower() == "del":
+            try:
+                peer_id = int(args[2])
+                if index.remove_group(peer_id):
+                    alerts.stop_where(lambda k: k[1] == peer_id)  # every subscriber's nags for it
+                    save_index(bot, index); pool.kick(); bot.send_message(f"Stopped watching peer_id={peer_id}.")
+                else: bot.send_message(f"peer_id={peer_id} is not watched.")
+            except ValueError: bot.send_message("Usage: /usegroup del <peer_id>")
+            return
+        if len(args) >= 2:
+            try:
+                try: peer_id = int(args[1])
+                except ValueError: peer_id = None
+                if peer_id in index.routes:
+                    index.current = peer_id  # already watched: just select it
+                elif peer_id in dialogs.chats:
+                    ent = dialogs.chats[peer_id]  # from the dialog index: no lookup needed
+                    index.add_group(peer_id, dialogs.title(peer_id)); index.remember_peer(ent)
+                else:
+                    peer_id = await add_group_from(args[1])
+                    if peer_id is None:
+                        bot.send_message("That id resolves to a USER, not a group. Use a negative peer_id.")
+                        return
+                save_index(bot, index); pool.kick()
+                bot.send_message(f"Group set: {index.title(peer_id)} (peer_id={peer_id})")
+            except Exception as e:
+                bot.send_message(f"Could not set group by id: {e}")
+        else: bot.send_message("Usage: /usegroup <peer_id>")
+
+    @commands.command("/setuser")
+    async def cmd_setuser(args: List[str], chat: Dict[str, Any]):
+        remove = len(args) >= 2 and args[1].lower() == "del"
+        rest = args[2:] if remove else args[1:]
+        if rest:
+            try:
+                who = rest[0].lstrip("@")
+                peer_id = int(rest[1]) if len(rest) >= 2 else index.current
+                if peer_id is None or peer_id not in index.routes:
+                    bot.send_message("No such watched group. Use /setgroup or /usegroup first.")
+                    return
+                if remove and not who.isdigit() and index.remove_pending(who, peer_id):
+                    save_index(bot, index); bot.send_message(f"User removed: @{who} from {index.title(peer_id)}")
+                    return
+                try: uid, uname = await resolve_user(who)
+                except Exception as e:
+                    if remove or who.isdigit(): raise
+                    index.add_pending(peer_id, who); save_index(bot, index)
+                    bot.send_message(f"User @{who} can't be resolved yet ({e}); matching by username in {index.title(peer_id)} until they post.")
+                    return
+                if remove:
+                    if index.remove_target(uid, peer_id):
+                        alerts.stop_where(lambda k: k[1:] == (peer_id, uid))
+                        save_index(bot, index); bot.send_message(f"User removed: @{uname or who} (id={uid}) from {index.title(peer_id)}")
+                    else: bot.send_message(f"@{uname or who} is not watched in {index.title(peer_id)}.")
+                    return
+                index.add_target(peer_id, uid, uname or who); save_index(bot, index)
+                bot.send_message(f"User set: @{uname or who} (id={uid}) in {index.title(peer_id)}")
+            except Exception as e:
+                bot.send_message(f"Could not set user: {e}")
+        else: bot.send_message("Usage: /setuser [del] <@username|id> [peer_id]")
+
+    @commands.command("/reset")
+    async def cmd_reset(args: List[str], chat: Dict[str, Any]):
+        global NAG_INTERVAL_SECONDS, MAX_NAGS
+        try:
+            alerts.stop()
+            NAG_INTERVAL_SECONDS = DEFAULT_NAG_INTERVAL_SECONDS; MAX_NAGS = DEFAULT_MAX_NAGS
+            bot.state["nag_interval"] = NAG_INTERVAL_SECONDS; bot.state["max_nags"] = MAX_NAGS
+            bot._save_state("nag_interval", "max_nags")
+            for sub in subs.chats.values(): sub.pop("interval", None); sub.pop("max_nags", None)
+            subs.save()
+            index.clear()
+            if GROUP_INVITE:
+                if await add_group_from(GROUP_INVITE, GROUP_INVITE) is None:
+                    raise RuntimeError("GROUP_INVITE resolved to a USER.")
+            if TARGET_USERNAME and index.current is not None:
+                try:
+                    uid, uname = await resolve_user(TARGET_USERNAME)
+                    index.add_target(index.current, uid, uname or TARGET_USERNAME)
+                except Exception:
+                    if TARGET_USERNAME.isdigit(): raise
+                    index.add_pending(index.current, TARGET_USERNAME)
+            save_index(bot, index); pool.kick()
+            bot.send_message("Reset done.")
+        except Exception as e:
+            save_index(bot, index)
+            bot.send_message(f"Reset failed: {e}")
+
+    @commands.command("/test", lane="high")
+    async def cmd_test(args: List[str], chat: Dict[str, Any]):
+        alerts.start((chat.get("id") or bot.chat_id, "test"), f"Manual test at {time.strftime('%Y-%m-%d %H:%M:%S')}", "(test)", "(test)", NAG_INTERVAL_SECONDS, MAX_NAGS)
+        bot.send_message("Test alerts started. Send /stop to stop.")
+
+    # ---- triggers ----
+    # Only chats present in index.routes reach the handler (see RoutedNewMessage).
+    media = MediaRelay(bot) if MEDIA_FORWARD else None
+    on_new_message = build_trigger_handler(bot, index, alerts, rules, media, subs, archive=archive)
+    pool = ShardPool([client] + extra, index, bot)
+    pool.load_state(bot.state.get("shards"))
+    recovery = GapRecovery(pool.client_for, index, bot, on_new_message)
+    recovery.mark_gap()  # everything after the saved watermarks was missed while we were down
+    pool.recovery = recovery
+    pool.attach(on_new_message)
+    pool.place_new()  # readability checks and rebalancing run in the shards leg, after the bot is up
+    client.add_event_handler(dialogs.on_chat_action, events.ChatAction())
+    dialogs.refresh(client)  # in the background; /listgroups says so until it is done
+
+    def notify(text: str):
+        for chat_id in subs.ids(): bot.send_message(text, chat_id=chat_id)
+    async def mtproto():
+        if not client.is_connected(): await client.connect()
+        await client.run_until_disconnected()
+    sup = Supervisor(notify)
+    sup.leg("Telegram (MTProto)", mtproto)
+    if BOT_MODE == "webhook": sup.leg("Bot API", lambda: bot.run_webhook(commands.dispatch, WEBHOOK_URL, WEBHOOK_SECRET))
+    else: sup.leg("Bot API", lambda: bot.run_polling(commands.dispatch))
+    sup.leg("nags", lambda: alerts.run(*make_nag_callbacks(bot)))
+    sup.leg("backfill", recovery.run)
+    sup.leg("shards", pool.run)
+    sup.probe("Bot API", lambda: bot.call("getMe", http_timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT_SECONDS)))
+    # get_me() is a real round trip; a dead connection is dropped so the MTProto leg reconnects
+    sup.probe("Telegram (MTProto)", client.get_me, on_down=client.disconnect)
+
+    METRICS.gauge("alerts_active", lambda: len(alerts))
+    METRICS.gauge("watched_groups", lambda: len(index.routes))
+    METRICS.gauge("watched_pairs", index.pair_count)
+    METRICS.gauge("bot_outbox_pending", lambda: sum(len(v) for v in bot._outbox.values()))
+    METRICS.gauge("bot_sends_in_flight", lambda: len(bot._sending))
+    METRICS.gauge("subscribers", lambda: len(subs.ids()))
+    METRICS.gauge("bursts_open", lambda: len(on_new_message.bursts))
+    METRICS.gauge("probes_degraded", lambda: len(sup.degraded()))
+    METRICS.gauge("shards_healthy", lambda: sum(1 for sh in pool.shards if pool.healthy(sh)))
+    METRICS.gauge("entity_cache_hits", lambda: index.entities.hits)
+    METRICS.gauge("entity_cache_misses", lambda: index.entities.misses)
+    if media: METRICS.gauge("media_transfers_active", lambda: media.active)
+    metrics_runner = await serve_metrics(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+
+    # queued on the serial lane so later config commands apply on top of it
+    commands.submit(seed_from_env, "(startup)")
+
+    phases = ", ".join(f"{k} {v:.2f}s" for k, v in timings.items())
+    print(f"[READY] Listener is live in {time.perf_counter() - t_start:.2f}s ({phases}; {len(index.peers)} cached peer(s)). DM /start to your bot, then /setgroup and /setuser.")
+    if extra: asyncio.create_task(pool.start())
+    try: await sup.run()
+    finally:
+        save_index(bot, index)  # keeps the entity cache warm across restarts
+        on_new_message.bursts.close()  # pending digests go out with the final outbox flush
+        if media: await media.close()
+        if archive: await archive.close()
+        await bot.close()
+        for c in extra: await c.disconnect()
+        if metrics_runner: await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     try: asyncio.run(main())